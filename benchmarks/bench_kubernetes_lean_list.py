@@ -0,0 +1,154 @@
+import inspect
+import json
+import os
+import sys
+import time
+import tracemalloc
+from kubernetes import client
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from kubernetes_lean_list import RecordList, deployment_record_from_json
+from kubernetes_health_check import record_deployment_metrics
+
+#Number of deployments in each synthetic list
+SIZES = [10, 100, 1000, 5000]
+
+#Number of times each path is timed; the best time is reported
+REPEAT = 3
+
+"""
+Build the raw JSON of a deployment with the fields a real deployment
+usually carries, so that deserialization cost is representative
+"""
+def synthetic_deployment(index):
+    name = 'service-{}'.format(index)
+    labels = {'app': name, 'tier': 'backend', 'release': 'stable'}
+    return {
+        'apiVersion': 'apps/v1beta1',
+        'kind': 'Deployment',
+        'metadata': {
+            'name': name,
+            'namespace': 'default',
+            'uid': '00000000-0000-0000-0000-{:012d}'.format(index),
+            'resourceVersion': str(1000 + index),
+            'generation': 3,
+            'creationTimestamp': '2018-06-01T12:00:00Z',
+            'labels': labels,
+            'annotations': {'deployment.kubernetes.io/revision': '3'}
+        },
+        'spec': {
+            'replicas': 2,
+            'selector': {'matchLabels': labels},
+            'strategy': {'type': 'RollingUpdate',
+                'rollingUpdate': {'maxSurge': 1, 'maxUnavailable': 1}},
+            'template': {
+                'metadata': {'labels': labels},
+                'spec': {
+                    'containers': [{
+                        'name': name,
+                        'image': 'registry.example.com/{}:1.0.{}'.format(name, index),
+                        'ports': [{'containerPort': 8080, 'protocol': 'TCP'}],
+                        'env': [{'name': 'VAR_{}'.format(i), 'value': str(i)} for i in range(5)],
+                        'resources': {'limits': {'cpu': '500m', 'memory': '512Mi'},
+                            'requests': {'cpu': '250m', 'memory': '256Mi'}},
+                        'imagePullPolicy': 'IfNotPresent'
+                    }],
+                    'restartPolicy': 'Always',
+                    'dnsPolicy': 'ClusterFirst'
+                }
+            }
+        },
+        'status': {
+            'observedGeneration': 3,
+            'replicas': 2,
+            'updatedReplicas': 2,
+            'readyReplicas': 2,
+            'availableReplicas': 2 if index % 10 else None,
+            'conditions': [{
+                'type': 'Available',
+                'status': 'True',
+                'lastUpdateTime': '2018-06-01T12:01:00Z',
+                'lastTransitionTime': '2018-06-01T12:01:00Z',
+                'reason': 'MinimumReplicasAvailable',
+                'message': 'Deployment has minimum availability.'
+            }]
+        }
+    }
+
+def synthetic_list_body(size):
+    return json.dumps({
+        'kind': 'DeploymentList',
+        'apiVersion': 'apps/v1beta1',
+        'metadata': {'resourceVersion': '999'},
+        'items': [synthetic_deployment(i) for i in range(size)]
+    }).encode('utf-8')
+
+"""
+Response object accepted by ApiClient.deserialize in older clients
+"""
+class FakeResponse(object):
+    def __init__(self, data):
+        self.data = data
+
+"""
+Publisher that only counts datums
+"""
+class CountingPublisher(object):
+    def __init__(self):
+        self.datums = 0
+
+    def put_metric(self, *args):
+        self.datums += 1
+
+"""
+Current path: deserialize into client models, then record metrics
+"""
+def model_path(api_client, model_type, body):
+    #Newer clients take the response text and its content type
+    if 'content_type' in inspect.signature(api_client.deserialize).parameters:
+        deployment_list = api_client.deserialize(body, model_type, 'application/json')
+    else:
+        deployment_list = api_client.deserialize(FakeResponse(body), model_type)
+    record_deployment_metrics(CountingPublisher(), deployment_list)
+
+"""
+Lean path: decode the JSON, keep the needed fields, then record metrics
+"""
+def lean_path(body):
+    page = json.loads(body)
+    deployment_list = RecordList([deployment_record_from_json(i) for i in page['items']])
+    record_deployment_metrics(CountingPublisher(), deployment_list)
+
+"""
+Return the best wall time in seconds and the peak traced memory in bytes
+"""
+def measure(function):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def main():
+    api_client = client.ApiClient()
+    model_type = 'V1beta1DeploymentList' if hasattr(client, 'V1beta1DeploymentList') else 'V1DeploymentList'
+
+    print('{:>8} {:>12} {:>12} {:>8} {:>12} {:>12}'.format(
+        'items', 'model (s)', 'lean (s)', 'speedup', 'model (KB)', 'lean (KB)'))
+    for size in SIZES:
+        body = synthetic_list_body(size)
+        model_time, model_peak = measure(lambda: model_path(api_client, model_type, body))
+        lean_time, lean_peak = measure(lambda: lean_path(body))
+        print('{:>8} {:>12.4f} {:>12.4f} {:>7.1f}x {:>12} {:>12}'.format(
+            size, model_time, lean_time, model_time / lean_time,
+            model_peak // 1024, lean_peak // 1024))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import boto3
+from kubernetes import client
+from moto import mock_aws
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import uptime
+from http_probe import ProbeEngine, ProbeSpec, create_timing_aggregator
+from kubernetes_health_check import record_deployment_metrics, record_stateful_set_metrics
+from metric_publisher import create_sink
+from self_metrics import INSTRUMENTATION
+
+"""
+Load simulation of the health check scripts against local stand-ins:
+Cloudwatch, SNS and S3 are served in process by moto, Kubernetes lists are
+synthetic client models and HTTP endpoints are a local server answering
+after a configurable latency. Every scenario runs at each scale and reports
+the best wall time, the number of AWS API calls (and HTTP requests for the
+probes) and the peak traced memory, which includes the memory of moto.
+
+The results can be saved as a baseline and later runs compared to it:
+
+    python bench_load_simulation.py --save-baseline baseline.json
+    python bench_load_simulation.py --baseline baseline.json
+
+baseline.json in this directory holds the results of the sizes 10, 100
+and 1000.
+
+A comparison exits with status 1 when a scenario got slower than the
+tolerance allows or makes more calls than in the baseline.
+"""
+
+#Number of workloads, endpoints or catalog resources in each run
+SIZES = [10, 100, 1000, 10000]
+
+#Largest scale of the scenarios that open one connection per item
+MAX_SIZES = {'http_probes': 1000}
+
+#Number of times each scenario is timed; the best time is reported
+REPEAT = 3
+
+#Seconds the local HTTP server waits before answering
+DEFAULT_LATENCY = 0.05
+
+#Ratio of the baseline wall time above which a run is a regression
+DEFAULT_TOLERANCE = 1.25
+
+#Seed of the synthetic workload states, so that every run sees the same data
+SEED = 42
+
+def set_environment():
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'METRICS_BACKEND': 'cloudwatch',
+        'METRICS_MAX_BACKLOG': '1000000',
+        'HEALTH_CHECK_FREQUENCY': '1'
+    })
+    for name in ('AWS_PROFILE', 'METRICS_AGGREGATION_PERIOD', 'SELF_METRICS',
+        'PROFILE_OUTPUT', 'UPTIME_CACHE', 'PROBE_TIMING_PERIOD'):
+        os.environ.pop(name, None)
+
+"""
+Build a list of deployments in which roughly one in ten is not fully
+available
+"""
+def synthetic_deployment_list(size, rng):
+    model = client.V1beta1Deployment if hasattr(client, 'V1beta1Deployment') else client.V1Deployment
+    model_list = client.V1beta1DeploymentList if hasattr(client, 'V1beta1DeploymentList') \
+        else client.V1DeploymentList
+    items = []
+    for index in range(size):
+        name = 'service-{}'.format(index)
+        replicas = rng.randint(1, 5)
+        available = replicas if rng.random() > 0.1 else rng.randint(0, replicas - 1)
+        items.append(model(
+            metadata=client.V1ObjectMeta(name=name, namespace='default'),
+            spec=client.V1DeploymentSpec(replicas=replicas,
+                selector=client.V1LabelSelector(match_labels={'app': name}),
+                template=client.V1PodTemplateSpec()),
+            status=client.V1DeploymentStatus(replicas=replicas,
+                updated_replicas=replicas, available_replicas=available)))
+    return model_list(items=items)
+
+def synthetic_stateful_set_list(size, rng):
+    items = []
+    for index in range(size):
+        name = 'store-{}'.format(index)
+        replicas = rng.randint(1, 5)
+        current = replicas if rng.random() > 0.1 else rng.randint(0, replicas - 1)
+        items.append(client.V1StatefulSet(
+            metadata=client.V1ObjectMeta(name=name, namespace='default'),
+            spec=client.V1StatefulSetSpec(replicas=replicas, service_name=name,
+                selector=client.V1LabelSelector(match_labels={'app': name}),
+                template=client.V1PodTemplateSpec()),
+            status=client.V1StatefulSetStatus(replicas=replicas, current_replicas=current)))
+    return client.V1StatefulSetList(items=items)
+
+"""
+HTTP server with a listen backlog large enough for the concurrent
+connections of the probes
+"""
+class BacklogServer(ThreadingHTTPServer):
+    request_queue_size = 256
+
+"""
+Local HTTP server answering every GET after latency seconds and counting
+the requests it serves
+"""
+class LatencyServer(object):
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.server = BacklogServer(('127.0.0.1', 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _handler_class(self):
+        server = self
+
+        class LatencyHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                time.sleep(server.latency)
+                with server.lock:
+                    server.requests += 1
+                body = b'{"status": "ok"}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return LatencyHandler
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}/{}'.format(self.server.server_address[1], path)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+"""
+Send the metrics recorded on a sink and close it
+"""
+def publish(sink):
+    sink.flush()
+    sink.close()
+
+"""
+Each scenario prepares its data for a scale, inside the moto mock, and
+returns the function that is timed. The function returns the number of
+requests it made to stand-ins that are not counted as AWS API calls.
+
+The metrics are recorded on the Cloudwatch sink itself rather than through
+create_publisher, whose background queue would add its polling interval
+to every run whatever the scale.
+"""
+def deployments_scenario(size, context):
+    deployment_list = synthetic_deployment_list(size, random.Random(SEED))
+
+    def run():
+        publisher = create_sink('cloudwatch')
+        record_deployment_metrics(publisher, deployment_list)
+        publish(publisher)
+        return 0
+    return run
+
+def stateful_sets_scenario(size, context):
+    stateful_set_list = synthetic_stateful_set_list(size, random.Random(SEED))
+
+    def run():
+        publisher = create_sink('cloudwatch')
+        record_stateful_set_metrics(publisher, stateful_set_list)
+        publish(publisher)
+        return 0
+    return run
+
+def http_probes_scenario(size, context):
+    server = context['server']
+    specs = [ProbeSpec('endpoint-{}'.format(i), server.url('health/{}'.format(i)),
+        'probe-metrics', 'endpoint_{}_health_check'.format(i),
+        'Endpoint{}HealthCheck'.format(i)) for i in range(size)]
+
+    def run():
+        before = server.requests
+        publisher = create_sink('cloudwatch')
+        timings = create_timing_aggregator(publisher)
+        engine = ProbeEngine()
+        try:
+            engine.check(specs, publisher, timings)
+        finally:
+            engine.close()
+        timings.close()
+        publish(publisher)
+        return server.requests - before
+    return run
+
+#Number of distinct synthetic health series shared by the catalog resources
+SERIES_POOL = 16
+
+"""
+HTTP response handed to botocore by StubbedGetMetricData
+"""
+class StubHttpResponse(object):
+    status_code = 200
+    headers = {}
+    content = b''
+
+"""
+Answers GetMetricData in botocore, before any request is sent, with an
+hour-by-hour series per query. moto keeps every datum and scans them all
+for each query, which grows with the square of the catalog and hides the
+cost of the script; this stand-in returns a month of datapoints for any
+catalog in constant time per query. Each resource is given one of
+SERIES_POOL deterministic series of Sums (60 checks an hour, a few failing)
+and SampleCounts.
+"""
+class StubbedGetMetricData(object):
+    def __init__(self, rng):
+        self.sums = [[60.0 - (rng.randint(0, 3) if rng.random() < 0.05 else 0)
+            for _ in range(31 * 24)] for _ in range(SERIES_POOL)]
+        self.counts = [60.0] * (31 * 24)
+
+    def register(self, events):
+        events.register('before-parameter-build.cloudwatch.GetMetricData', self.keep_params)
+        events.register('before-call.cloudwatch.GetMetricData', self.respond)
+
+    def keep_params(self, params, context, **kwargs):
+        context['stub_params'] = params
+
+    def respond(self, context, **kwargs):
+        params = context['stub_params']
+        start_time = params['StartTime'].replace(minute=0, second=0, microsecond=0)
+        hours = int((params['EndTime'] - start_time).total_seconds()) // 3600
+        timestamps = [start_time + uptime.datetime.timedelta(hours=h) for h in range(hours)]
+
+        results = []
+        for query in params['MetricDataQueries']:
+            statistic, index = query['Id'].rsplit('_', 1)
+            values = self.counts if statistic == 'samplecount' \
+                else self.sums[int(index) % SERIES_POOL]
+            results.append({'Id': query['Id'], 'Label': query['Id'], 'StatusCode': 'Complete',
+                'Timestamps': timestamps, 'Values': values[:hours]})
+        return StubHttpResponse(), {'MetricDataResults': results, 'Messages': [],
+            'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+"""
+uptime.main over a catalog of deployments, a month of health metrics each.
+SNS and S3 are served by moto and the report is archived to S3, as the
+text of a large catalog does not fit in one SNS message.
+"""
+def uptime_report_scenario(size, context):
+    catalog = os.path.join(context['directory'], 'catalog-{}.json'.format(size))
+    with open(catalog, 'w') as f:
+        json.dump({'resources': [{'name': 'service-{}'.format(i), 'kind': 'deployment'}
+            for i in range(size)]}, f)
+
+    boto3.setup_default_session()
+    StubbedGetMetricData(random.Random(SEED)).register(boto3.DEFAULT_SESSION.events)
+    topic = boto3.client('sns').create_topic(Name='uptime-report')['TopicArn']
+    boto3.client('s3').create_bucket(Bucket='uptime-reports')
+    os.environ.update({'RESOURCE_CATALOG': catalog, 'TOPIC_ARN': topic,
+        'REPORT_BUCKET': 'uptime-reports'})
+
+    def run():
+        uptime.main()
+        return 0
+    return run
+
+SCENARIOS = [
+    ('record_deployments', deployments_scenario),
+    ('record_stateful_sets', stateful_sets_scenario),
+    ('http_probes', http_probes_scenario),
+    ('uptime_report', uptime_report_scenario)
+]
+
+"""
+Run a prepared scenario once in a fresh moto backend and return its wall
+time, AWS API calls and other requests
+"""
+def run_once(scenario, size, context, trace_memory=False):
+    with mock_aws(), contextlib.redirect_stdout(io.StringIO()):
+        run = scenario(size, context)
+        calls_before = INSTRUMENTATION.counters.get('aws_api_calls', 0)
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        requests = run()
+        elapsed = time.perf_counter() - start
+        peak = 0
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        calls = INSTRUMENTATION.counters.get('aws_api_calls', 0) - calls_before
+    return elapsed, calls, requests, peak
+
+"""
+Return the best wall time in seconds, the AWS API calls and other requests
+of one run, and the peak traced memory in bytes
+"""
+def measure(scenario, size, context, repeat):
+    best = None
+    for _ in range(repeat):
+        elapsed, calls, requests, _ = run_once(scenario, size, context)
+        best = elapsed if best is None else min(best, elapsed)
+
+    _, _, _, peak = run_once(scenario, size, context, trace_memory=True)
+    return {'wall_time': best, 'api_calls': calls, 'requests': requests, 'peak_kb': peak // 1024}
+
+"""
+Compare a result to its baseline and return the text of the comparison and
+whether it is a regression
+"""
+def compare(result, baseline, tolerance):
+    if baseline is None:
+        return 'new', False
+    ratio = result['wall_time'] / baseline['wall_time'] if baseline['wall_time'] else 1.0
+    regression = ratio > tolerance or result['api_calls'] > baseline['api_calls'] \
+        or result['requests'] > baseline['requests']
+    calls = result['api_calls'] - baseline['api_calls']
+    return '{:.2f}x time, {:+d} calls{}'.format(ratio, calls,
+        ' REGRESSION' if regression else ''), regression
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the health check scripts '
+        'against local stand-ins of AWS, Kubernetes and HTTP endpoints')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in SIZES),
+        help='comma separated scales (default: %(default)s)')
+    parser.add_argument('--scenarios', default=','.join(name for name, _ in SCENARIOS),
+        help='comma separated scenarios (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+        help='timed runs of each scenario (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+        help='seconds the HTTP server waits before answering (default: %(default)s)')
+    parser.add_argument('--save-baseline', metavar='PATH',
+        help='write the results to this JSON file')
+    parser.add_argument('--baseline', metavar='PATH',
+        help='compare the results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help='wall time ratio above which a run is a regression (default: %(default)s)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    set_environment()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    names = args.scenarios.split(',')
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    server = LatencyServer(args.latency)
+    results = {}
+    regressions = 0
+    print('{:<22} {:>8} {:>10} {:>10} {:>10} {:>10}  {}'.format(
+        'scenario', 'size', 'time (s)', 'API calls', 'requests', 'peak (KB)',
+        'baseline' if args.baseline else ''))
+    with tempfile.TemporaryDirectory() as directory:
+        context = {'server': server, 'directory': directory}
+        for name, scenario in SCENARIOS:
+            if name not in names:
+                continue
+            for size in sizes:
+                if size > MAX_SIZES.get(name, size):
+                    continue
+                key = '{}/{}'.format(name, size)
+                result = results[key] = measure(scenario, size, context, args.repeat)
+                comparison = ''
+                if args.baseline:
+                    comparison, regression = compare(result, baseline.get(key), args.tolerance)
+                    regressions += regression
+                print('{:<22} {:>8} {:>10.4f} {:>10} {:>10} {:>10}  {}'.format(
+                    name, size, result['wall_time'], result['api_calls'],
+                    result['requests'], result['peak_kb'], comparison))
+    server.close()
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if regressions:
+        print('{} regressions against {}'.format(regressions, args.baseline))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
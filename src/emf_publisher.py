@@ -0,0 +1,224 @@
+import json
+import socket
+import sys
+import threading
+import time
+
+#Output used when the EMF_OUTPUT environment variable is not set
+DEFAULT_OUTPUT = 'stdout'
+
+#Maximum number of entries in the Values/Counts arrays of one metric in an
+#EMF document
+MAX_EMF_VALUES = 100
+
+"""
+Build one Embedded Metric Format document holding a single metric. The
+dimensions are the health check dimension plus any extra dimensions given
+as a list of {'Name': ..., 'Value': ...}, all in one dimension set, which
+is the same metric identity PutMetricData would create.
+"""
+def create_emf_document(namespace, metric_name, dimension_name, dimension_value,
+    value, extra_dimensions=None, timestamp=None, unit=None):
+
+    dimensions = [{'Name': dimension_name, 'Value': dimension_value}] \
+        + list(extra_dimensions or [])
+    document = {
+        '_aws': {
+            'Timestamp': int((timestamp or time.time()) * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [[d['Name'] for d in dimensions]],
+                'Metrics': [{'Name': metric_name}]
+            }]
+        },
+        metric_name: value
+    }
+    if unit is not None:
+        document['_aws']['CloudWatchMetrics'][0]['Metrics'][0]['Unit'] = unit
+    for dimension in dimensions:
+        document[dimension['Name']] = dimension['Value']
+    return document
+
+"""
+The metric values of the EMF documents representing a
+metric_aggregator.StatisticSet, one per document. Each value holds
+Values/Counts arrays of at most MAX_EMF_VALUES distinct values with the
+Count, Sum, Min and Max of those samples, so that however many samples
+there are, the documents together add up to the whole set. A set that no
+longer counts its distinct values is one document with its statistics only.
+"""
+def emf_values(statistics):
+    if statistics.values is None:
+        return [{'Count': statistics.sample_count, 'Sum': statistics.sum,
+            'Min': statistics.minimum, 'Max': statistics.maximum}]
+
+    distinct = sorted(statistics.values)
+    documents = []
+    for start in range(0, len(distinct), MAX_EMF_VALUES):
+        values = distinct[start:start + MAX_EMF_VALUES]
+        counts = [statistics.values[value] for value in values]
+        documents.append({
+            'Values': values,
+            'Counts': counts,
+            'Count': sum(counts),
+            'Sum': sum(value * count for value, count in zip(values, counts)),
+            'Min': values[0],
+            'Max': values[-1]
+        })
+    return documents
+
+"""
+Writes lines to standard output
+"""
+class StdoutOutput(object):
+    def write(self, data):
+        sys.stdout.write(data)
+        sys.stdout.flush()
+
+    def close(self):
+        pass
+
+"""
+Appends lines to a local file, for instance one tailed by the Cloudwatch
+agent
+"""
+class FileOutput(object):
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, data):
+        with open(self.path, 'a') as f:
+            f.write(data)
+
+    def close(self):
+        pass
+
+"""
+Sends lines to the Cloudwatch agent over TCP or UDP. The TCP connection is
+kept open between writes and opened again once if it was closed.
+"""
+class SocketOutput(object):
+    def __init__(self, protocol, host, port):
+        self.protocol = protocol
+        self.address = (host, port)
+        self.socket = None
+
+    def _connect(self):
+        if self.protocol == 'udp':
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.socket = socket.create_connection(self.address)
+
+    def write(self, data):
+        if self.protocol == 'udp':
+            if self.socket is None:
+                self._connect()
+            #One datagram per document
+            for line in data.splitlines(True):
+                self.socket.sendto(line.encode('utf-8'), self.address)
+            return
+
+        for attempt in range(2):
+            try:
+                if self.socket is None:
+                    self._connect()
+                self.socket.sendall(data.encode('utf-8'))
+                return
+            except OSError:
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+"""
+Create the output of an EMF_OUTPUT value: 'stdout', 'tcp://host:port',
+'udp://host:port' or the path of a file
+"""
+def create_output(value):
+    if value == 'stdout':
+        return StdoutOutput()
+    for protocol in ('tcp', 'udp'):
+        prefix = protocol + '://'
+        if value.startswith(prefix):
+            host, port = value[len(prefix):].rsplit(':', 1)
+            return SocketOutput(protocol, host, int(port))
+    return FileOutput(value)
+
+"""
+Buffers metrics and writes them as Cloudwatch Embedded Metric Format JSON
+lines, for the Cloudwatch agent (or Lambda/ECS log routing) to turn into
+metrics. It has the same interface as MetricPublisher, so the health checks
+use it without change, but it makes no API calls: a flush is one local
+write.
+"""
+class EMFPublisher(object):
+    def __init__(self, output):
+        self.output = output
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.datums_published = 0
+        self.datums_failed = 0
+        self.api_calls = 0
+
+    """
+    Add a metric to the buffer. The metric is timestamped when it is added.
+    """
+    def put_metric(self, namespace, metric_name, dimension_name,
+        dimension_value, value, extra_dimensions=None):
+
+        document = create_emf_document(namespace, metric_name, dimension_name,
+            dimension_value, value, extra_dimensions)
+        with self.lock:
+            self.buffer.append(document)
+
+    """
+    Add a metric aggregating many samples, from a
+    metric_aggregator.StatisticSet, to the buffer. The set takes more than
+    one document when it has more than MAX_EMF_VALUES distinct values.
+    """
+    def put_statistics(self, namespace, metric_name, dimension_name,
+        dimension_value, statistics, extra_dimensions=None, unit=None):
+
+        timestamp = time.time()
+        documents = [create_emf_document(namespace, metric_name, dimension_name,
+            dimension_value, value, extra_dimensions, timestamp, unit)
+            for value in emf_values(statistics)]
+        with self.lock:
+            self.buffer.extend(documents)
+
+    """
+    Write every buffered metric, one JSON document per line, and empty the
+    buffer
+    """
+    def flush(self):
+        with self.lock:
+            buffer = self.buffer
+            self.buffer = []
+
+        if not buffer:
+            return
+
+        try:
+            self.output.write(''.join(json.dumps(d) + '\n' for d in buffer))
+        except OSError as e:
+            print("Failed to write {} EMF metrics: {}".format(len(buffer), e))
+            self.datums_failed += len(buffer)
+            return
+        self.datums_published += len(buffer)
+
+    def close(self):
+        self.output.close()
+
+    def calls_saved(self):
+        return self.datums_published
+
+    """
+    Print a one line summary of the publishing activity
+    """
+    def report(self):
+        print("Wrote {} metrics ({} failed) in Embedded Metric Format, saving {} calls".format(
+            self.datums_published, self.datums_failed, self.calls_saved()))
@@ -0,0 +1,186 @@
+import os
+import random
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metric_publisher import create_publisher
+from resource_catalog import load_catalog
+from self_metrics import INSTRUMENTATION, run_instrumented, self_metrics_enabled, stage
+import http_probe
+import kubernetes_health_check
+import kubernetes_pod_health
+
+"""
+A health check run by the scheduler every interval seconds. The first run
+is delayed by a random jitter so that checks sharing an interval do not all
+start at the same moment.
+"""
+class ScheduledCheck(object):
+    def __init__(self, name, function, interval, jitter):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.next_run = time.time() + random.uniform(0, jitter)
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+
+"""
+Runs health checks on their intervals inside one process. Each check is a
+function taking no arguments which records its metrics with the shared
+publisher; the scheduler flushes the publisher once the check returns.
+Probe timings added to the scheduler's timings aggregator are published
+once per PROBE_TIMING_PERIOD.
+
+A check that is still running when its next run is due is skipped for that
+tick instead of being started a second time, so a slow dependency cannot
+pile up overlapping runs.
+"""
+class HealthCheckScheduler(object):
+    def __init__(self, publisher, max_workers=4):
+        self.publisher = publisher
+        self.timings = http_probe.create_timing_aggregator(publisher)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.checks = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    """
+    Register a check. The jitter defaults to the whole interval.
+    """
+    def add_check(self, name, function, interval, jitter=None):
+        if jitter is None:
+            jitter = interval
+        self.checks.append(ScheduledCheck(name, function, interval, jitter))
+
+    """
+    Start every check that is due and return the time of the next due check
+    """
+    def run_pending(self, now):
+        for check in self.checks:
+            if check.next_run > now:
+                continue
+
+            #Schedule the next run on the interval grid, skipping any runs
+            #that were missed entirely
+            while check.next_run <= now:
+                check.next_run += check.interval
+
+            with self.lock:
+                if check.running:
+                    check.skipped += 1
+                    print("Skipping {} check, previous run is still in progress".format(check.name))
+                    continue
+                check.running = True
+
+            self.executor.submit(self._run_check, check)
+
+        return min(check.next_run for check in self.checks)
+
+    """
+    Run a check and publish its metrics, including those recorded before
+    the check failed. Errors are printed so that one failing check does not
+    stop the daemon.
+    """
+    def _run_check(self, check):
+        try:
+            with stage(check.name):
+                check.function()
+        except Exception as e:
+            print("{} check failed: {}".format(check.name, e))
+        finally:
+            #The metrics recorded before a failure are published as well
+            try:
+                if self_metrics_enabled():
+                    INSTRUMENTATION.publish(self.publisher, 'health_check_daemon')
+                self.timings.flush()
+                self.publisher.flush()
+            except Exception as e:
+                print("Publishing the metrics of the {} check failed: {}".format(check.name, e))
+            with self.lock:
+                check.running = False
+                check.runs += 1
+
+    """
+    Run the checks until stop is called
+    """
+    def run_forever(self):
+        while not self.stopped.is_set():
+            next_run = self.run_pending(time.time())
+            self.stopped.wait(max(0, next_run - time.time()))
+
+        self.executor.shutdown()
+        self.timings.close()
+        self.publisher.flush()
+        self.publisher.close()
+
+    def stop(self, *args):
+        self.stopped.set()
+
+"""
+Read the interval of one check from its environment variable, falling back
+to HEALTH_CHECK_FREQUENCY
+"""
+def get_check_frequency(variable, default):
+    return float(os.environ.get(variable, default))
+
+"""
+Add a check to the scheduler for every check whose environment variables
+are set. Clients are created once here and reused on every run.
+"""
+def add_configured_checks(scheduler):
+    default_frequency = float(os.environ.get('HEALTH_CHECK_FREQUENCY', 60.0))
+    publisher = scheduler.publisher
+
+    if 'KUBECONFIG' in os.environ:
+        kubeconfig, targets = kubernetes_health_check.get_kubernetes_targets()
+        apis = kubernetes_health_check.create_kubernetes_apis(kubeconfig, targets)
+        pod_tracker = kubernetes_pod_health.create_pod_tracker()
+        if os.environ.get('KUBERNETES_WATCH', '').lower() == 'true':
+            caches = {}
+            for kubecontext, kubernetes_namespace in targets:
+                caches[(kubecontext, kubernetes_namespace)] = kubernetes_health_check.create_watch_caches(
+                    apis[kubecontext], kubernetes_namespace)
+            def check_target(kubecontext, kubernetes_namespace, extra_dimensions):
+                kubernetes_health_check.check_watch_caches(publisher,
+                    *caches[(kubecontext, kubernetes_namespace)], extra_dimensions=extra_dimensions)
+                #Pods are listed on every run, the caches only hold workloads
+                if pod_tracker is not None:
+                    kubernetes_pod_health.check_pod_health(apis[kubecontext], publisher,
+                        kubernetes_namespace, pod_tracker, extra_dimensions)
+            target_executor = None
+        else:
+            lean = kubernetes_health_check.use_lean_list()
+            check_target = lambda kubecontext, kubernetes_namespace, extra_dimensions: kubernetes_health_check.check_kubernetes_namespace(
+                apis[kubecontext], publisher, kubernetes_namespace, extra_dimensions, lean, pod_tracker)
+            target_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('KUBERNETES_MAX_WORKERS',
+                kubernetes_health_check.DEFAULT_MAX_WORKERS)))
+        scheduler.add_check('kubernetes',
+            lambda: kubernetes_health_check.check_kubernetes_targets(targets, check_target,
+                target_executor, publisher),
+            get_check_frequency('KUBERNETES_CHECK_FREQUENCY', default_frequency))
+
+    #The HTTP probes of the resource catalog, which include the NGINX and
+    #query endpoint checks
+    specs = http_probe.catalog_probe_specs(load_catalog())
+    if specs:
+        probe_engine = http_probe.ProbeEngine()
+        scheduler.add_check('http-probes',
+            lambda: probe_engine.check(specs, publisher, scheduler.timings),
+            get_check_frequency('PROBE_CHECK_FREQUENCY', default_frequency))
+
+def main():
+    scheduler = HealthCheckScheduler(
+        kubernetes_health_check.change_only_publisher(create_publisher()))
+    add_configured_checks(scheduler)
+
+    if not scheduler.checks:
+        raise Exception('No checks configured: set KUBECONFIG, or the environment variables of the catalog probes')
+
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    scheduler.run_forever()
+
+if __name__ == '__main__':
+    run_instrumented(main, 'health_check_daemon')
@@ -0,0 +1,279 @@
+import asyncio
+import json
+import os
+import threading
+import aiohttp
+from metric_aggregator import DEFAULT_PERIOD, MetricAggregator, record_probe_timings
+from metric_publisher import create_publisher
+from resilience import CircuitOpenError, circuit_breaker
+from resource_catalog import load_catalog, probe_resources
+from self_metrics import run_instrumented, stage
+
+#Timeout in seconds used for a probe that does not set its own
+DEFAULT_TIMEOUT = 10.0
+
+#Built-in probe types. A probe with a type takes its method and expected
+#status from here unless the probe sets them itself.
+PROBE_TYPES = {
+    'head_redirect': {
+        'method': 'HEAD',
+        'expected_status': 302
+    },
+    'post_ok': {
+        'method': 'POST',
+        'expected_status': 200
+    }
+}
+
+"""
+Description of one HTTP endpoint to probe and of the health metric recorded
+for it. A probe is healthy when the endpoint answers within the timeout
+with the expected status code.
+"""
+class ProbeSpec(object):
+    def __init__(self, name, url, namespace, metric_name, dimension_value,
+        dimension_name='HealthCheck', probe_type=None, method=None,
+        expected_status=None, username=None, password=None, body=None,
+        headers=None, timeout=DEFAULT_TIMEOUT, extra_dimensions=None):
+
+        defaults = PROBE_TYPES.get(probe_type, {})
+        self.name = name
+        self.url = url
+        self.namespace = namespace
+        self.metric_name = metric_name
+        self.dimension_name = dimension_name
+        self.dimension_value = dimension_value
+        self.method = method or defaults.get('method', 'GET')
+        self.expected_status = expected_status or defaults.get('expected_status', 200)
+        self.username = username
+        self.password = password
+        self.body = body
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.extra_dimensions = extra_dimensions
+
+    """
+    Create a probe from the probe entry of a catalog resource. Any key
+    ending in '_env' is replaced by the value of the environment variable it
+    names, so that URLs and credentials can stay out of the catalog. A body
+    given as a JSON object is serialized and sent as application/json.
+    """
+    @classmethod
+    def from_config(cls, entry):
+        entry = dict(entry)
+        for key in list(entry):
+            if key.endswith('_env'):
+                entry[key[:-len('_env')]] = os.environ[entry.pop(key)]
+
+        if 'type' in entry:
+            entry['probe_type'] = entry.pop('type')
+
+        if isinstance(entry.get('body'), (dict, list)):
+            entry['body'] = json.dumps(entry['body'])
+            entry.setdefault('headers', {})['content-type'] = 'application/json'
+
+        return cls(**entry)
+
+"""
+Outcome of one probe. status is None when no response was received, either
+because the request failed or because the circuit breaker of the endpoint
+is open and no request was made.
+timings holds the durations in milliseconds of the phases of the request
+that took place, among dns_time, connect_time (TCP connection and TLS
+handshake), time_to_first_byte and total_time; size is the number of bytes
+of the response body.
+"""
+class ProbeResult(object):
+    def __init__(self, spec, healthy, status=None, error=None, timings=None,
+        size=None):
+        self.spec = spec
+        self.healthy = healthy
+        self.status = status
+        self.error = error
+        self.timings = timings or {}
+        self.size = size
+
+"""
+Create the trace configuration that times the phases of each request into
+the dictionary passed as trace_request_ctx. A request reusing a pooled
+connection has no dns_time or connect_time.
+"""
+def create_trace_config():
+    trace_config = aiohttp.TraceConfig()
+    loop_time = lambda: asyncio.get_event_loop().time()
+
+    def phase_start(name):
+        async def on_start(session, context, params):
+            context.trace_request_ctx[name + '_start'] = loop_time()
+        return on_start
+
+    def phase_end(name):
+        async def on_end(session, context, params):
+            timings = context.trace_request_ctx
+            if name + '_start' in timings:
+                timings[name] = 1000 * (loop_time() - timings.pop(name + '_start'))
+        return on_end
+
+    async def on_connection_create_end(session, context, params):
+        timings = context.trace_request_ctx
+        timings['connect_time'] = 1000 * (loop_time() - timings.pop('connect_time_start')) \
+            - timings.get('dns_time', 0.0)
+
+    trace_config.on_request_start.append(phase_start('time_to_first_byte'))
+    trace_config.on_request_end.append(phase_end('time_to_first_byte'))
+    trace_config.on_dns_resolvehost_start.append(phase_start('dns_time'))
+    trace_config.on_dns_resolvehost_end.append(phase_end('dns_time'))
+    trace_config.on_connection_create_start.append(phase_start('connect_time'))
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+"""
+Create the probes of the catalog resources that have a 'probe' entry.
+A probe whose environment variables are not set is skipped.
+"""
+def catalog_probe_specs(resources):
+    specs = []
+    for resource in probe_resources(resources):
+        entry = dict(resource.probe, name=resource.name,
+            namespace=resource.namespace, metric_name=resource.metric_name,
+            dimension_name=resource.dimension_name,
+            dimension_value=resource.dimension_value,
+            extra_dimensions=resource.extra_dimensions)
+        try:
+            specs.append(ProbeSpec.from_config(entry))
+        except KeyError as e:
+            print("Skipping probe {}, missing environment variable: {}".format(resource.name, e))
+    return specs
+
+"""
+Probe one endpoint. Redirects are not followed so that redirect statuses
+such as 302 can be checked. Requests that fail or time out count against
+the circuit breaker of the endpoint; while it is open the endpoint is not
+requested and counts as down, since the breaker only opens on failures of
+the endpoint itself.
+"""
+async def run_probe(session, spec):
+    breaker = circuit_breaker('http:' + spec.name)
+    if not breaker.allow():
+        return ProbeResult(spec, False,
+            error=CircuitOpenError('Circuit breaker http:{} is open'.format(spec.name)))
+
+    auth = None
+    if spec.username is not None:
+        auth = aiohttp.BasicAuth(spec.username, spec.password)
+
+    timings = {}
+    start = asyncio.get_event_loop().time()
+    try:
+        async with session.request(spec.method, spec.url, data=spec.body,
+            headers=spec.headers, auth=auth, allow_redirects=False,
+            timeout=aiohttp.ClientTimeout(total=spec.timeout),
+            trace_request_ctx=timings) as response:
+            body = await response.read()
+            status = response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        breaker.record_failure()
+        print("{} request to {} failed: {!r}".format(spec.method, spec.name, e))
+        return ProbeResult(spec, False, error=e)
+    except BaseException:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+
+    timings = dict((name, value) for name, value in timings.items()
+        if not name.endswith('_start'))
+    timings['total_time'] = 1000 * (asyncio.get_event_loop().time() - start)
+
+    if status != spec.expected_status:
+        print("{} request to {} returned a non-{} status code: {}".format(
+            spec.method, spec.name, spec.expected_status, status))
+
+    return ProbeResult(spec, status == spec.expected_status, status=status,
+        timings=timings, size=len(body))
+
+"""
+Probe every endpoint at the same time and return the results in the order
+of the probes
+"""
+async def run_probes(session, specs):
+    return await asyncio.gather(*[run_probe(session, spec) for spec in specs])
+
+"""
+Record the binary health metric of each probe: 1.0 for healthy, else 0.0.
+When an aggregator is given, the timings and response size of each probe
+are added to it as probe_* samples with the dimensions of the health
+metric.
+"""
+def record_probe_results(publisher, results, timings=None):
+    for result in results:
+        spec = result.spec
+        publisher.put_metric(spec.namespace, spec.metric_name,
+            spec.dimension_name, spec.dimension_value,
+            1.0 if result.healthy else 0.0, spec.extra_dimensions)
+        if timings is not None:
+            record_probe_timings(timings, spec.namespace, spec.dimension_name,
+                spec.dimension_value, result.timings, result.size, spec.extra_dimensions)
+
+"""
+Create the aggregator of probe timings for a publisher. Timings are
+published every PROBE_TIMING_PERIOD seconds (60 by default).
+"""
+def create_timing_aggregator(publisher):
+    return MetricAggregator(publisher,
+        float(os.environ.get('PROBE_TIMING_PERIOD', DEFAULT_PERIOD)))
+
+"""
+Runs probes from an event loop on a background thread. The HTTP session,
+and so its open connections, is kept between calls to probe, which lets a
+long-running process reuse connections from one check to the next.
+"""
+class ProbeEngine(object):
+    def __init__(self, limit=100):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.session = self._call(self._create_session(limit))
+
+    async def _create_session(self, limit):
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit),
+            trace_configs=[create_trace_config()])
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    """
+    Probe the endpoints concurrently and return the list of results
+    """
+    def probe(self, specs):
+        return self._call(run_probes(self.session, specs))
+
+    """
+    Probe the endpoints and record their health metrics with the publisher,
+    and their timings with the aggregator when one is given
+    """
+    def check(self, specs, publisher, timings=None):
+        with stage('http_probes'):
+            results = self.probe(specs)
+        record_probe_results(publisher, results, timings)
+
+    def close(self):
+        self._call(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+def main():
+    specs = catalog_probe_specs(load_catalog())
+    publisher = create_publisher()
+    timings = create_timing_aggregator(publisher)
+    engine = ProbeEngine()
+    try:
+        engine.check(specs, publisher, timings)
+    finally:
+        engine.close()
+
+    timings.close()
+    publisher.close()
+
+if __name__ == '__main__':
+    run_instrumented(main, 'http_probe')
@@ -2,28 +2,34 @@ from kubernetes import client, config
 import boto3
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
+from metric_publisher import create_publisher
+from metric_sinks import DEFAULT_HEARTBEAT, ChangeOnlySink
+from kubernetes_watch_cache import WatchCache
+from resource_catalog import create_metric_name, create_dimension_value
+from kubernetes_lean_list import deployment_record, stateful_set_record
+from kubernetes_lean_list import list_deployment_records, list_stateful_set_records
+from kubernetes_lean_list import kubernetes_retryable
+from kubernetes_pod_health import check_pod_health, create_pod_tracker
+from resilience import (call_with_retries, circuit_breaker, dependency_timeout,
+    record_unknown)
+from self_metrics import count, run_instrumented, stage
+
+#Default number of (context, namespace) targets collected at the same time
+DEFAULT_MAX_WORKERS = 8
+
+#Dimension names of the desired/current/updated/available gauges, which
+#change-only publishing may skip. The health check metrics are always sent.
+GAUGE_DIMENSIONS = ('DeploymentMetric', 'StatefulSetMetric')
 
 """
-Wrapper to call Cloudwatch put metric function
+Wrapper to add a metric to the batched Cloudwatch metric publisher
 """
-def put_metric_wrapper(cloudwatch, namespace, metric_name, dimension_name, 
-    dimension_value, value):
+def put_metric_wrapper(publisher, namespace, metric_name, dimension_name, 
+    dimension_value, value, extra_dimensions=None):
     
-    cloudwatch.put_metric_data(
-        Namespace=namespace,
-        MetricData=[
-            {
-                'MetricName': metric_name,
-                'Dimensions': [
-                    {
-                        'Name': dimension_name,
-                        'Value': dimension_value
-                    },
-                ],
-                'Value': value
-            },
-        ]
-    )
+    publisher.put_metric(namespace, metric_name, dimension_name,
+        dimension_value, value, extra_dimensions)
     
 """
 Check if variable is None. If it is None, change the value to 0.
@@ -45,64 +51,71 @@ For each deployment in a deployment list, record metrics in
 Cloudwatch for the number of desired, current, up-to-date, and
 available pods. Also record a binary health metric for each 
 deployment's status (up or down). Metrics are placed in the
-'k8s-metrics' Cloudwatch namespace.
+'k8s-metrics' Cloudwatch namespace, with any extra dimensions given.
 """
-def record_deployment_metrics(cloudwatch, deployment_list):
+def record_deployment_metrics(publisher, deployment_list, extra_dimensions=None):
     for i in deployment_list.items:
+        #Items are client models or the records of the lean list path
+        record = deployment_record(i)
+
         #Deployment name
-        name = i.metadata.name
+        name = record.name
         
         #Number of available pods for the deployment. Value between 0 and n.
-        available = none_check(i.status.available_replicas)
+        available = none_check(record.available)
         
         #Number of current pods for the deployment. Value between 0 and n.
-        current = none_check(i.status.replicas)
+        current = none_check(record.current)
         
         #Number of up-to-date pods for the deployment. Value between 0 and n.
-        updated = none_check(i.status.updated_replicas)
+        updated = none_check(record.updated)
         
         #Number of desired pods for the deployment. Value between 0 and n.
-        desired = none_check(i.spec.replicas)
+        desired = none_check(record.desired)
         
         #Record the number of desired pods for the deployment
         metric_name = create_metric_name(name, '_deployment_desired')
         dimension_value = create_dimension_value(name, 'DeploymentDesired')
-        put_metric_wrapper(cloudwatch=cloudwatch, 
+        put_metric_wrapper(publisher=publisher, 
             namespace='k8s-metrics', 
             metric_name=metric_name, 
             dimension_name='DeploymentMetric', 
             dimension_value=dimension_value, 
-            value=desired)
+            value=desired, 
+            extra_dimensions=extra_dimensions)
         
         #Record the number of current pods for the deployment
         metric_name = create_metric_name(name, '_deployment_current')
         dimension_value = create_dimension_value(name, 'DeploymentCurrent')
-        put_metric_wrapper(cloudwatch=cloudwatch, 
+        put_metric_wrapper(publisher=publisher, 
             namespace='k8s-metrics', 
             metric_name=metric_name, 
             dimension_name='DeploymentMetric', 
             dimension_value=dimension_value, 
-            value=current)
+            value=current, 
+            extra_dimensions=extra_dimensions)
         
         #Record the number of up-to-date pods for the deployment
         metric_name = create_metric_name(name, '_deployment_updated')
         dimension_value = create_dimension_value(name, 'DeploymentUpdated')
-        put_metric_wrapper(cloudwatch=cloudwatch, 
+        put_metric_wrapper(publisher=publisher, 
             namespace='k8s-metrics', 
             metric_name=metric_name, 
             dimension_name='DeploymentMetric', 
             dimension_value=dimension_value, 
-            value=updated)
+            value=updated, 
+            extra_dimensions=extra_dimensions)
         
         #Record the number of available pods for the deployment
         metric_name = create_metric_name(name, '_deployment_available')
         dimension_value = create_dimension_value(name, 'DeploymentAvailable')
-        put_metric_wrapper(cloudwatch=cloudwatch, 
+        put_metric_wrapper(publisher=publisher, 
             namespace='k8s-metrics', 
             metric_name=metric_name, 
             dimension_name='DeploymentMetric', 
             dimension_value=dimension_value, 
-            value=available)
+            value=available, 
+            extra_dimensions=extra_dimensions)
         
         #Record the health metric: if the number of available pods
         #in the deployment is greater than 0, the deployment is 'up' 
@@ -110,56 +123,63 @@ def record_deployment_metrics(cloudwatch, deployment_list):
         metric_name = create_metric_name(name, '_deployment_health_check')
         dimension_value = create_dimension_value(name, 'DeploymentHealthCheck')
         if available > 0:
-            put_metric_wrapper(cloudwatch=cloudwatch, 
+            put_metric_wrapper(publisher=publisher, 
                 namespace='k8s-metrics', 
                 metric_name=metric_name, 
                 dimension_name='HealthCheck', 
                 dimension_value=dimension_value, 
-                value=1.0)
+                value=1.0, 
+                extra_dimensions=extra_dimensions)
         else:
-            put_metric_wrapper(cloudwatch=cloudwatch, 
+            put_metric_wrapper(publisher=publisher, 
                 namespace='k8s-metrics', 
                 metric_name=metric_name, 
                 dimension_name='HealthCheck', 
                 dimension_value=dimension_value, 
-                value=0.0)
+                value=0.0, 
+                extra_dimensions=extra_dimensions)
 
 """
 For each stateful set in a stateful set list, record metrics in Cloudwatch
 for the number of desired and current pods. Also record a binary health 
 metric for each stateful set's status (up or down). Metrics are placed in the
-'k8s-metrics' Cloudwatch namespace.
+'k8s-metrics' Cloudwatch namespace, with any extra dimensions given.
 """
-def record_stateful_set_metrics(cloudwatch, stateful_set_list):
+def record_stateful_set_metrics(publisher, stateful_set_list, extra_dimensions=None):
     for i in stateful_set_list.items:
+        #Items are client models or the records of the lean list path
+        record = stateful_set_record(i)
+
         #Stateful set name
-        name = i.metadata.name
+        name = record.name
         
         #Number of desired pods for the stateful set. Value between 0 and n.
-        desired = none_check(i.spec.replicas)
+        desired = none_check(record.desired)
         
         #Number of current pods for the stateful set. Value between 0 and n.
-        current = none_check(i.status.current_replicas)
+        current = none_check(record.current)
         
         #Record the number of desired pods for the stateful set
         metric_name = create_metric_name(name, '_statefulset_desired')
         dimension_value = create_dimension_value(name, 'StatefulSetDesired')
-        put_metric_wrapper(cloudwatch=cloudwatch, 
+        put_metric_wrapper(publisher=publisher, 
             namespace='k8s-metrics', 
             metric_name=metric_name, 
             dimension_name='StatefulSetMetric', 
             dimension_value=dimension_value, 
-            value=desired)
+            value=desired, 
+            extra_dimensions=extra_dimensions)
         
         #Record the number of current pods for the stateful set
         metric_name = create_metric_name(name, '_statefulset_current')
         dimension_value = create_dimension_value(name, 'StatefulSetCurrent')
-        put_metric_wrapper(cloudwatch=cloudwatch, 
+        put_metric_wrapper(publisher=publisher, 
             namespace='k8s-metrics', 
             metric_name=metric_name, 
             dimension_name='StatefulSetMetric', 
             dimension_value=dimension_value, 
-            value=current)
+            value=current, 
+            extra_dimensions=extra_dimensions)
         
         #Record the health metric: if the number of current pods
         #in the stateful set is greater than 0, the stateful set is 'up'
@@ -167,55 +187,239 @@ def record_stateful_set_metrics(cloudwatch, stateful_set_list):
         metric_name = create_metric_name(name, '_statefulset_health_check')
         dimension_value = create_dimension_value(name, 'StatefulSetHealthCheck')
         if current > 0:
-            put_metric_wrapper(cloudwatch=cloudwatch, 
+            put_metric_wrapper(publisher=publisher, 
                 namespace='k8s-metrics', 
                 metric_name=metric_name, 
                 dimension_name='HealthCheck', 
                 dimension_value=dimension_value, 
-                value=1.0)
+                value=1.0, 
+                extra_dimensions=extra_dimensions)
         else:
-            put_metric_wrapper(cloudwatch=cloudwatch, 
+            put_metric_wrapper(publisher=publisher, 
                 namespace='k8s-metrics', 
                 metric_name=metric_name, 
                 dimension_name='HealthCheck', 
                 dimension_value=dimension_value, 
-                value=0.0)
+                value=0.0, 
+                extra_dimensions=extra_dimensions)
             
 """
-Concatenate the name and suffix
+Read the Kubernetes environment variables and return the tuple
+(kubeconfig, kubecontext, kubernetes_namespace)
 """
-def create_metric_name(name, suffix):
-    return name + suffix
-    
-"""
-Create a dimension value by capitalizing the first letter of the base name
-and then appending the suffix. For instance base=mybase, suffix=MySuffix
-results in MybaseMySuffix.
-"""
-def create_dimension_value(name, suffix):
-    return str.upper(name[0]) + name[1:] + suffix
-        
-def main():
+def get_kubernetes_settings():
     try:
         kubeconfig = os.environ['KUBECONFIG']
         kubecontext = os.environ['PRODUCTION_KUBECTL_CONTEXT']
         kubernetes_namespace = os.environ['KUBERNETES_NAMESPACE']
     except:
         raise Exception('Missing environment variable: KUBECONFIG, PRODUCTION_KUBECTL_CONTEXT, or KUBERNETES_NAMESPACE')
-        
-    config.load_kube_config(config_file=kubeconfig, context=kubecontext)
-    cloudwatch = boto3.client('cloudwatch')
 
-    #For deployments and stateful sets use
-    k8s_api = client.AppsV1beta1Api()
+    return kubeconfig, kubecontext, kubernetes_namespace
+
+"""
+Read the list of (context, namespace) targets from KUBERNETES_TARGETS and
+return the tuple (kubeconfig, targets). KUBERNETES_TARGETS is a comma
+separated list of context=namespace pairs, for instance
+prod=default,prod=monitoring,stage=default. When it is not set, the single
+target from PRODUCTION_KUBECTL_CONTEXT and KUBERNETES_NAMESPACE is used.
+"""
+def get_kubernetes_targets():
+    if 'KUBERNETES_TARGETS' not in os.environ:
+        kubeconfig, kubecontext, kubernetes_namespace = get_kubernetes_settings()
+        return kubeconfig, [(kubecontext, kubernetes_namespace)]
+
+    try:
+        kubeconfig = os.environ['KUBECONFIG']
+    except:
+        raise Exception('Missing environment variable: KUBECONFIG')
+
+    targets = []
+    for target in os.environ['KUBERNETES_TARGETS'].split(','):
+        kubecontext, separator, kubernetes_namespace = target.strip().rpartition('=')
+        if not separator or not kubecontext or not kubernetes_namespace:
+            raise Exception('Invalid KUBERNETES_TARGETS entry, expected context=namespace: ' + target)
+        targets.append((kubecontext, kubernetes_namespace))
+
+    return kubeconfig, targets
+
+"""
+Load the kubeconfig and return the API used for deployments and stateful
+sets. The returned API keeps its connection pool, so it can be reused for
+every check made by a long-running process.
+"""
+def create_kubernetes_api(kubeconfig, kubecontext):
+    api_client = config.new_client_from_config(config_file=kubeconfig, context=kubecontext)
+    return client.AppsV1beta1Api(api_client)
+
+"""
+Create one API per context used by the targets and return them in a
+dictionary keyed by context
+"""
+def create_kubernetes_apis(kubeconfig, targets):
+    apis = {}
+    for kubecontext, kubernetes_namespace in targets:
+        if kubecontext not in apis:
+            apis[kubecontext] = create_kubernetes_api(kubeconfig, kubecontext)
+    return apis
+
+"""
+Extra dimensions identifying the cluster and namespace of a target. They
+are only added when there is more than one target, so that the metrics of
+a single target keep the dimensions used by the uptime report.
+"""
+def target_dimensions(targets, kubecontext, kubernetes_namespace):
+    if len(targets) == 1:
+        return None
+
+    return [
+        {
+            'Name': 'Cluster',
+            'Value': kubecontext
+        },
+        {
+            'Name': 'Namespace',
+            'Value': kubernetes_namespace
+        },
+    ]
 
+"""
+Get the deployments and stateful sets in the namespace and record their
+metrics with the publisher. With lean set, the lists are paged and read as
+raw JSON instead of being deserialized into client models. When a pod
+restart tracker is given, the pods are also listed and the pod metrics of
+each workload recorded.
+"""
+def check_kubernetes_namespace(k8s_api, publisher, kubernetes_namespace,
+    extra_dimensions=None, lean=False, pod_tracker=None):
     #Get the list of deployments and stateful sets
-    deployment_list = k8s_api.list_namespaced_deployment(namespace=kubernetes_namespace, watch=False)
-    stateful_set_list = k8s_api.list_namespaced_stateful_set(namespace=kubernetes_namespace, watch=False)
+    if lean:
+        with stage('list_deployments'):
+            deployment_list = list_deployment_records(k8s_api, kubernetes_namespace)
+        with stage('list_stateful_sets'):
+            stateful_set_list = list_stateful_set_records(k8s_api, kubernetes_namespace)
+    else:
+        timeout = dependency_timeout('kubernetes')
+        with stage('list_deployments'):
+            deployment_list = call_with_retries(lambda: k8s_api.list_namespaced_deployment(
+                namespace=kubernetes_namespace, watch=False, _request_timeout=timeout),
+                kubernetes_retryable)
+        with stage('list_stateful_sets'):
+            stateful_set_list = call_with_retries(lambda: k8s_api.list_namespaced_stateful_set(
+                namespace=kubernetes_namespace, watch=False, _request_timeout=timeout),
+                kubernetes_retryable)
+        count('kubernetes_api_calls', 2)
     
     #Record the metrics in Cloudwatch for each deployment and stateful set
-    record_deployment_metrics(cloudwatch, deployment_list)
-    record_stateful_set_metrics(cloudwatch, stateful_set_list)
+    with stage('record_metrics'):
+        record_deployment_metrics(publisher, deployment_list, extra_dimensions)
+        record_stateful_set_metrics(publisher, stateful_set_list, extra_dimensions)
+
+    if pod_tracker is not None:
+        check_pod_health(k8s_api, publisher, kubernetes_namespace, pod_tracker,
+            extra_dimensions)
+
+"""
+Call check_target(kubecontext, kubernetes_namespace, extra_dimensions) for
+every target. With an executor the targets are checked at the same time.
+A target that fails is reported without stopping the other targets; an
+exception is raised once all targets are done if any of them failed. When
+a publisher is given, each failed target is recorded as a check_unknown
+metric.
+"""
+def check_kubernetes_targets(targets, check_target, executor=None, publisher=None):
+    if executor is None:
+        results = [run_target_check(targets, target, check_target, publisher)
+            for target in targets]
+    else:
+        futures = [executor.submit(run_target_check, targets, target, check_target, publisher)
+            for target in targets]
+        results = [future.result() for future in futures]
+
+    failures = [target for target, ok in zip(targets, results) if not ok]
+    if failures:
+        raise Exception('Kubernetes check failed for targets: ' + ', '.join(
+            '{}={}'.format(kubecontext, kubernetes_namespace)
+            for kubecontext, kubernetes_namespace in failures))
+
+"""
+Check one target and return True if it succeeded. The calls to each
+cluster go through its circuit breaker: while the breaker is open the
+target is not checked, so an unreachable API server does not hold up the
+run, and its workloads are left without health metrics (unknown, not down).
+"""
+def run_target_check(targets, target, check_target, publisher=None):
+    kubecontext, kubernetes_namespace = target
+    try:
+        circuit_breaker('kubernetes:' + kubecontext).call(check_target, kubecontext,
+            kubernetes_namespace, target_dimensions(targets, kubecontext, kubernetes_namespace))
+        return True
+    except Exception as e:
+        print("Kubernetes check failed for {}={}: {}".format(kubecontext, kubernetes_namespace, e))
+        if publisher is not None:
+            record_unknown(publisher, 'k8s-metrics', 'KubernetesTarget',
+                '{}={}'.format(kubecontext, kubernetes_namespace))
+        return False
+
+"""
+Start watch caches for the deployments and stateful sets in the namespace
+and return the tuple (deployment_cache, stateful_set_cache)
+"""
+def create_watch_caches(k8s_api, kubernetes_namespace):
+    deployment_cache = WatchCache(k8s_api.list_namespaced_deployment, kubernetes_namespace)
+    stateful_set_cache = WatchCache(k8s_api.list_namespaced_stateful_set, kubernetes_namespace)
+    deployment_cache.start()
+    stateful_set_cache.start()
+    return deployment_cache, stateful_set_cache
+
+"""
+Record the metrics of the deployments and stateful sets held in watch
+caches, without calling the Kubernetes API
+"""
+def check_watch_caches(publisher, deployment_cache, stateful_set_cache,
+    extra_dimensions=None):
+    record_deployment_metrics(publisher, deployment_cache.snapshot(), extra_dimensions)
+    record_stateful_set_metrics(publisher, stateful_set_cache.snapshot(), extra_dimensions)
+
+"""
+Wrap the publisher so that the pod count gauges are only published when
+they change or every GAUGE_HEARTBEAT seconds, when GAUGE_STATE_FILE names
+the file keeping their last published values. Otherwise the publisher is
+returned as is.
+"""
+def change_only_publisher(publisher):
+    if 'GAUGE_STATE_FILE' not in os.environ:
+        return publisher
+
+    return ChangeOnlySink(publisher, os.environ['GAUGE_STATE_FILE'], GAUGE_DIMENSIONS,
+        float(os.environ.get('GAUGE_HEARTBEAT', DEFAULT_HEARTBEAT)))
+
+"""
+Whether KUBERNETES_LEAN_LIST selects the raw JSON list path
+"""
+def use_lean_list():
+    return os.environ.get('KUBERNETES_LEAN_LIST', '').lower() == 'true'
+
+def main():
+    kubeconfig, targets = get_kubernetes_targets()
+    with stage('load_kubeconfig'):
+        apis = create_kubernetes_apis(kubeconfig, targets)
+    publisher = change_only_publisher(create_publisher())
+    max_workers = int(os.environ.get('KUBERNETES_MAX_WORKERS', DEFAULT_MAX_WORKERS))
+    lean = use_lean_list()
+    pod_tracker = create_pod_tracker()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            check_kubernetes_targets(targets,
+                lambda kubecontext, kubernetes_namespace, extra_dimensions: check_kubernetes_namespace(
+                    apis[kubecontext], publisher, kubernetes_namespace, extra_dimensions,
+                    lean, pod_tracker),
+                executor, publisher)
+        finally:
+            with stage('publish'):
+                publisher.close()
+            publisher.report()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    run_instrumented(main, 'kubernetes_health_check')
\ No newline at end of file
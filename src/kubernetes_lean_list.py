@@ -0,0 +1,126 @@
+import json
+import urllib3
+from kubernetes.client.rest import ApiException
+from resilience import call_with_retries, dependency_timeout
+from self_metrics import count
+
+#Number of objects requested per page when listing
+DEFAULT_PAGE_SIZE = 500
+
+#HTTP statuses of the Kubernetes API worth retrying
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+"""
+Whether a Kubernetes API call failed with a transient error: a timeout, a
+connection error or a throttling or server error status
+"""
+def kubernetes_retryable(error):
+    if isinstance(error, ApiException):
+        return error.status in RETRYABLE_STATUSES
+    return isinstance(error, (urllib3.exceptions.HTTPError, OSError))
+
+"""
+The few fields of a deployment or stateful set used to record its metrics.
+Fields the Kubernetes API left unset are None, as in the client models.
+Stateful sets only use desired and current.
+"""
+class WorkloadRecord(object):
+    __slots__ = ('name', 'desired', 'current', 'updated', 'available')
+
+    def __init__(self, name, desired, current, updated=None, available=None):
+        self.name = name
+        self.desired = desired
+        self.current = current
+        self.updated = updated
+        self.available = available
+
+"""
+List result holding workload records
+"""
+class RecordList(object):
+    def __init__(self, items):
+        self.items = items
+
+"""
+Return the record of a deployment given either a client model or a record
+"""
+def deployment_record(item):
+    if isinstance(item, WorkloadRecord):
+        return item
+
+    return WorkloadRecord(item.metadata.name, item.spec.replicas,
+        item.status.replicas, item.status.updated_replicas,
+        item.status.available_replicas)
+
+"""
+Return the record of a stateful set given either a client model or a record
+"""
+def stateful_set_record(item):
+    if isinstance(item, WorkloadRecord):
+        return item
+
+    return WorkloadRecord(item.metadata.name, item.spec.replicas,
+        item.status.current_replicas)
+
+"""
+Build a deployment record from the raw JSON of one list item
+"""
+def deployment_record_from_json(item):
+    spec = item.get('spec') or {}
+    status = item.get('status') or {}
+    return WorkloadRecord(item['metadata']['name'], spec.get('replicas'),
+        status.get('replicas'), status.get('updatedReplicas'),
+        status.get('availableReplicas'))
+
+"""
+Build a stateful set record from the raw JSON of one list item
+"""
+def stateful_set_record_from_json(item):
+    spec = item.get('spec') or {}
+    status = item.get('status') or {}
+    return WorkloadRecord(item['metadata']['name'], spec.get('replicas'),
+        status.get('currentReplicas'))
+
+"""
+Page through a namespaced list call without deserializing the response into
+client models. Each page is decoded as plain JSON and only the fields read
+by from_json are kept. A field_selector such as 'status.phase=Running' is
+applied by the API server. Each page is requested with the Kubernetes
+timeout and retried on transient errors.
+"""
+def list_records(list_function, namespace, from_json, limit=DEFAULT_PAGE_SIZE,
+    field_selector=None):
+    records = []
+    continue_token = None
+
+    while True:
+        kwargs = {'namespace': namespace, 'limit': limit, '_preload_content': False,
+            '_request_timeout': dependency_timeout('kubernetes')}
+        if field_selector:
+            kwargs['field_selector'] = field_selector
+        if continue_token:
+            kwargs['_continue'] = continue_token
+
+        data = call_with_retries(lambda: list_function(**kwargs).data, kubernetes_retryable)
+        count('kubernetes_api_calls')
+        count('kubernetes_bytes_received', len(data))
+        page = json.loads(data)
+        records.extend(from_json(item) for item in page.get('items') or [])
+
+        continue_token = (page.get('metadata') or {}).get('continue')
+        if not continue_token:
+            return RecordList(records)
+
+"""
+List the deployments of a namespace as workload records
+"""
+def list_deployment_records(k8s_api, namespace, limit=DEFAULT_PAGE_SIZE):
+    return list_records(k8s_api.list_namespaced_deployment, namespace,
+        deployment_record_from_json, limit)
+
+"""
+List the stateful sets of a namespace as workload records
+"""
+def list_stateful_set_records(k8s_api, namespace, limit=DEFAULT_PAGE_SIZE):
+    return list_records(k8s_api.list_namespaced_stateful_set, namespace,
+        stateful_set_record_from_json, limit)
@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+from kubernetes import client
+from kubernetes_lean_list import DEFAULT_PAGE_SIZE, list_records
+from resource_catalog import create_metric_name, create_dimension_value
+from self_metrics import stage
+
+#Pods that finished are left out by the API server
+POD_FIELD_SELECTOR = 'status.phase!=Succeeded,status.phase!=Failed'
+
+#Metric name prefix, dimension value prefix and dimension name of the pod
+#metrics of each workload kind. The dimension names differ from those of
+#the pod count gauges so that change-only publishing never skips them.
+WORKLOAD_KINDS = {
+    'Deployment': ('_deployment', 'Deployment', 'DeploymentPodMetric'),
+    'StatefulSet': ('_statefulset', 'StatefulSet', 'StatefulSetPodMetric')
+}
+
+"""
+The few fields of a pod used to record the pod metrics of its workload.
+owner_kind and owner_name are those of the workload owning the pod, or None
+for a pod without a controller.
+"""
+class PodRecord(object):
+    __slots__ = ('uid', 'owner_kind', 'owner_name', 'phase', 'ready', 'restarts')
+
+    def __init__(self, uid, owner_kind, owner_name, phase, ready, restarts):
+        self.uid = uid
+        self.owner_kind = owner_kind
+        self.owner_name = owner_name
+        self.phase = phase
+        self.ready = ready
+        self.restarts = restarts
+
+"""
+Return the (kind, name) of the workload owning a pod. A pod of a deployment
+is owned by a ReplicaSet named after the deployment and the
+pod-template-hash label of the pod, so the deployment is found without
+listing the ReplicaSets.
+"""
+def pod_owner(metadata):
+    for owner in metadata.get('ownerReferences') or []:
+        if not owner.get('controller'):
+            continue
+        kind, name = owner['kind'], owner['name']
+        template_hash = (metadata.get('labels') or {}).get('pod-template-hash')
+        if kind == 'ReplicaSet' and template_hash and name.endswith('-' + template_hash):
+            return 'Deployment', name[:-len(template_hash) - 1]
+        return kind, name
+    return None, None
+
+"""
+Build a pod record from the raw JSON of one list item. The restarts are
+summed over the containers and init containers of the pod.
+"""
+def pod_record_from_json(item):
+    metadata = item['metadata']
+    status = item.get('status') or {}
+    owner_kind, owner_name = pod_owner(metadata)
+    ready = any(condition.get('type') == 'Ready' and condition.get('status') == 'True'
+        for condition in status.get('conditions') or [])
+    restarts = sum(container.get('restartCount') or 0 for container in
+        (status.get('containerStatuses') or []) + (status.get('initContainerStatuses') or []))
+    return PodRecord(metadata['uid'], owner_kind, owner_name, status.get('phase'),
+        ready, restarts)
+
+"""
+List the pods of a namespace that have not finished, as pod records
+"""
+def list_pod_records(core_api, namespace, limit=DEFAULT_PAGE_SIZE):
+    return list_records(core_api.list_namespaced_pod, namespace, pod_record_from_json,
+        limit, POD_FIELD_SELECTOR)
+
+"""
+Pod counts of one workload
+"""
+class WorkloadPods(object):
+    __slots__ = ('pods', 'ready', 'pending', 'restarts')
+
+    def __init__(self):
+        self.pods = 0
+        self.ready = 0
+        self.pending = 0
+        self.restarts = 0
+
+"""
+Remembers the restart count of every pod so that each check records the
+restarts since the previous check. The counts are kept per scope (a
+namespace of a cluster), so that pods deleted since the previous check are
+forgotten. The first check of a scope only sets the starting counts. When
+a path is given, the counts are kept in that JSON file between runs.
+"""
+class PodRestartTracker(object):
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.scopes = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.scopes = json.load(f)
+            except (OSError, ValueError) as e:
+                print("Ignoring unreadable pod state {}: {}".format(path, e))
+
+    """
+    Return a dictionary of the restarts of each pod since the previous
+    check of the scope, and remember the current counts
+    """
+    def deltas(self, scope, pods):
+        with self.lock:
+            previous = self.scopes.get(scope)
+            self.scopes[scope] = dict((pod.uid, pod.restarts) for pod in pods)
+
+        if previous is None:
+            return dict((pod.uid, 0) for pod in pods)
+        #A pod created since the previous check restarted restarts times
+        return dict((pod.uid, max(0, pod.restarts - previous.get(pod.uid, 0)))
+            for pod in pods)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            temporary_path = self.path + '.tmp'
+            with open(temporary_path, 'w') as f:
+                json.dump(self.scopes, f)
+            os.replace(temporary_path, self.path)
+
+"""
+Group the pods by owning workload in one pass and return a dictionary of
+WorkloadPods keyed by (kind, name). restart_deltas gives the restarts of
+each pod to count, by pod uid.
+"""
+def index_pods(pods, restart_deltas):
+    workloads = {}
+    for pod in pods:
+        if pod.owner_kind not in WORKLOAD_KINDS:
+            continue
+        key = (pod.owner_kind, pod.owner_name)
+        workload = workloads.get(key)
+        if workload is None:
+            workload = workloads[key] = WorkloadPods()
+        workload.pods += 1
+        workload.ready += pod.ready
+        workload.pending += pod.phase == 'Pending'
+        workload.restarts += restart_deltas.get(pod.uid, 0)
+    return workloads
+
+"""
+For each workload with pods, record the ratio of its pods that are ready,
+the container restarts since the previous check and the number of pending
+pods. A workload with crash-looping or unscheduled pods can still have
+available replicas, which these metrics make visible.
+"""
+def record_pod_metrics(publisher, workloads, extra_dimensions=None):
+    for (kind, name), workload in sorted(workloads.items()):
+        metric_prefix, dimension_prefix, dimension_name = WORKLOAD_KINDS[kind]
+        for suffix, dimension_suffix, value in [
+            ('_ready_ratio', 'ReadyRatio', float(workload.ready) / workload.pods),
+            ('_restarts', 'Restarts', workload.restarts),
+            ('_pending', 'Pending', workload.pending)]:
+
+            publisher.put_metric('k8s-metrics',
+                create_metric_name(name, metric_prefix + suffix), dimension_name,
+                create_dimension_value(name, dimension_prefix + dimension_suffix),
+                value, extra_dimensions)
+
+"""
+List the pods of the namespace once and record the pod metrics of its
+deployments and stateful sets. k8s_api is the apps API of the namespace's
+cluster; the pods are listed with the core API sharing its client.
+"""
+def check_pod_health(k8s_api, publisher, kubernetes_namespace, tracker,
+    extra_dimensions=None):
+
+    core_api = client.CoreV1Api(k8s_api.api_client)
+    with stage('list_pods'):
+        pods = list_pod_records(core_api, kubernetes_namespace).items
+
+    scope = '|'.join([kubernetes_namespace] + [d['Value'] for d in extra_dimensions or []])
+    with stage('record_pod_metrics'):
+        record_pod_metrics(publisher, index_pods(pods, tracker.deltas(scope, pods)),
+            extra_dimensions)
+    tracker.save()
+
+"""
+Create the restart tracker when KUBERNETES_POD_HEALTH is true, keeping its
+counts in POD_STATE_FILE when set, or return None
+"""
+def create_pod_tracker():
+    if os.environ.get('KUBERNETES_POD_HEALTH', '').lower() != 'true':
+        return None
+    return PodRestartTracker(os.environ.get('POD_STATE_FILE'))
@@ -0,0 +1,159 @@
+import threading
+import time
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+from resilience import dependency_timeout
+
+#Seconds the API server keeps a watch open before it is restarted
+WATCH_TIMEOUT = 300
+
+#Seconds past WATCH_TIMEOUT after which the client gives up on a watch the
+#API server did not close, for instance over a dropped connection
+WATCH_TIMEOUT_MARGIN = 30
+
+#Seconds to wait before restarting a watch that failed
+RETRY_DELAY = 5
+
+#Seconds after which the cache is considered stale if the watch keeps
+#failing to reach the API server
+MAX_STALENESS = 180
+
+"""
+Minimal stand-in for a Kubernetes list result, so that cached objects can
+be passed to the same functions as the result of a list call
+"""
+class CachedList(object):
+    def __init__(self, items):
+        self.items = items
+
+"""
+Informer-style local cache of the objects of one kind in a namespace.
+
+The cache is filled by one list call and then kept up to date by applying
+the events of a watch started from the resource version of that list. When
+the watch times out it is restarted from the last resource version seen; a
+full list is only made again when the API server reports that resource
+version as expired (HTTP 410 Gone). A watch still open WATCH_TIMEOUT_MARGIN
+seconds after the API server should have closed it is dropped and counted
+as a failure, so a silent connection cannot keep the cache stale unnoticed.
+
+If the watch keeps failing for longer than max_staleness seconds, snapshot
+raises instead of returning objects that may be out of date.
+"""
+class WatchCache(object):
+    def __init__(self, list_function, namespace, watch_timeout=WATCH_TIMEOUT,
+        max_staleness=MAX_STALENESS):
+
+        self.list_function = list_function
+        self.namespace = namespace
+        self.watch_timeout = watch_timeout
+        self.max_staleness = max_staleness
+        self.objects = {}
+        self.resource_version = None
+        self.failing_since = None
+        self.lists = 0
+        self.events = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    """
+    Make the initial list and start watching for changes
+    """
+    def start(self):
+        self._list()
+        self.thread = threading.Thread(target=self._watch_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    """
+    Return the cached objects, sorted by name, as a list result
+    """
+    def snapshot(self):
+        with self.lock:
+            if self.failing_since is not None and time.time() - self.failing_since > self.max_staleness:
+                raise Exception('Watch cache for namespace {} has been failing for {} seconds'.format(
+                    self.namespace, int(time.time() - self.failing_since)))
+            return CachedList([self.objects[name] for name in sorted(self.objects)])
+
+    """
+    Replace the cache with the result of a full list call
+    """
+    def _list(self):
+        result = self.list_function(namespace=self.namespace, watch=False,
+            _request_timeout=dependency_timeout('kubernetes'))
+        with self.lock:
+            self.objects = dict((i.metadata.name, i) for i in result.items)
+            self.resource_version = result.metadata.resource_version
+            self.failing_since = None
+            self.lists += 1
+
+    def _watch_loop(self):
+        while not self.stopped.is_set():
+            try:
+                self._watch()
+                with self.lock:
+                    self.failing_since = None
+            except ApiException as e:
+                if e.status == 410:
+                    self._relist()
+                else:
+                    self._failed('Watch', e)
+            except Exception as e:
+                self._failed('Watch', e)
+
+    """
+    List again after the resource version expired, retrying until it works
+    """
+    def _relist(self):
+        while not self.stopped.is_set():
+            try:
+                self._list()
+                return
+            except Exception as e:
+                self._failed('List', e)
+
+    """
+    Record the start of a run of failures and wait before trying again
+    """
+    def _failed(self, operation, error):
+        print("{} for namespace {} failed: {}".format(operation, self.namespace, error))
+        with self.lock:
+            if self.failing_since is None:
+                self.failing_since = time.time()
+        self.stopped.wait(RETRY_DELAY)
+
+    """
+    Apply the events of one watch until it times out
+    """
+    def _watch(self):
+        w = watch.Watch()
+        for event in w.stream(self.list_function, namespace=self.namespace,
+            resource_version=self.resource_version,
+            timeout_seconds=self.watch_timeout,
+            _request_timeout=self.watch_timeout + WATCH_TIMEOUT_MARGIN):
+
+            if self.stopped.is_set():
+                w.stop()
+                return
+
+            event_type = event['type']
+            obj = event['object']
+
+            #Older clients pass expired resource versions through as an
+            #ERROR event instead of raising
+            if event_type == 'ERROR':
+                code = obj.get('code') if isinstance(obj, dict) else getattr(obj, 'code', None)
+                raise ApiException(status=code, reason='Watch error event')
+
+            with self.lock:
+                if event_type == 'DELETED':
+                    self.objects.pop(obj.metadata.name, None)
+                elif event_type in ('ADDED', 'MODIFIED'):
+                    self.objects[obj.metadata.name] = obj
+                self.resource_version = obj.metadata.resource_version
+                self.failing_since = None
+                self.events += 1
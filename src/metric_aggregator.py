@@ -0,0 +1,112 @@
+import threading
+import time
+
+#Maximum number of distinct values in the Values/Counts arrays of one
+#PutMetricData datum
+MAX_DISTINCT_VALUES = 150
+
+#Seconds over which samples are aggregated before they are published
+DEFAULT_PERIOD = 60
+
+"""
+Running SampleCount/Sum/Min/Max of the samples of one metric over a
+period. The count of each distinct value is also kept, so that Cloudwatch
+can compute percentiles from Values/Counts arrays, until there are more
+distinct values than one datum can carry.
+"""
+class StatisticSet(object):
+    def __init__(self):
+        self.sample_count = 0
+        self.sum = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.values = {}
+
+    def add(self, value, count=1):
+        self.sample_count += count
+        self.sum += value * count
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        if self.values is not None:
+            self.values[value] = self.values.get(value, 0) + count
+            if len(self.values) > MAX_DISTINCT_VALUES:
+                self.values = None
+
+    """
+    The Cloudwatch StatisticValues of the set
+    """
+    def statistic_values(self):
+        return {
+            'SampleCount': self.sample_count,
+            'Sum': self.sum,
+            'Minimum': self.minimum,
+            'Maximum': self.maximum
+        }
+
+"""
+Folds samples into one StatisticSet per (namespace, metric, dimensions)
+and publishes each set once per period with the put_statistics method of
+a publisher, so that the number of datums does not grow with the number
+of samples.
+
+flush publishes the sets only once period seconds have passed since the
+last publish, unless force is set; close always publishes what is left.
+"""
+class MetricAggregator(object):
+    def __init__(self, publisher, period=DEFAULT_PERIOD):
+        self.publisher = publisher
+        self.period = period
+        self.lock = threading.Lock()
+        self.sets = {}
+        self.units = {}
+        self.last_publish = time.monotonic()
+
+    """
+    Add one sample. unit is a Cloudwatch unit such as 'Milliseconds'.
+    """
+    def add(self, namespace, metric_name, dimension_name, dimension_value,
+        value, extra_dimensions=None, unit=None):
+
+        key = (namespace, metric_name, dimension_name, dimension_value,
+            tuple((d['Name'], d['Value']) for d in extra_dimensions or []))
+        with self.lock:
+            statistic_set = self.sets.get(key)
+            if statistic_set is None:
+                statistic_set = self.sets[key] = StatisticSet()
+                self.units[key] = unit
+            statistic_set.add(value)
+
+    def flush(self, force=False):
+        with self.lock:
+            if not force and time.monotonic() - self.last_publish < self.period:
+                return
+            sets = self.sets
+            units = self.units
+            self.sets = {}
+            self.units = {}
+            self.last_publish = time.monotonic()
+
+        for key in sorted(sets, key=str):
+            namespace, metric_name, dimension_name, dimension_value, extra = key
+            self.publisher.put_statistics(namespace, metric_name, dimension_name,
+                dimension_value, sets[key],
+                [{'Name': name, 'Value': value} for name, value in extra] or None,
+                units[key])
+
+    def close(self):
+        self.flush(force=True)
+
+"""
+Add the timings in milliseconds and the response size in bytes of one
+probe to a MetricAggregator. Timings are rounded to the millisecond so
+that the samples of an interval share few distinct values.
+"""
+def record_probe_timings(timings, namespace, dimension_name, dimension_value,
+    durations, size=None, extra_dimensions=None):
+
+    for name in sorted(durations):
+        timings.add(namespace, 'probe_' + name, dimension_name, dimension_value,
+            float(round(durations[name])), extra_dimensions, 'Milliseconds')
+    if size is not None:
+        timings.add(namespace, 'probe_response_size', dimension_name, dimension_value,
+            float(size), extra_dimensions, 'Bytes')
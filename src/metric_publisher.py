@@ -0,0 +1,324 @@
+import os
+import threading
+import time
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+from emf_publisher import DEFAULT_OUTPUT, EMFPublisher, create_output
+from resilience import backoff_delay, boto_config, circuit_breaker
+from self_metrics import instrument_client
+from metric_sinks import (DEFAULT_FLUSH_INTERVAL, DEFAULT_MAX_BACKLOG,
+    DEFAULT_PROMETHEUS_PORT, AggregatingSink, FanoutSink, JsonLinesSink,
+    PrometheusSink, QueuedSink)
+
+#Maximum number of metric datums accepted by a single PutMetricData request
+MAX_DATUMS_PER_REQUEST = 1000
+
+#Number of attempts made to publish a batch before it is dropped
+MAX_ATTEMPTS = 3
+
+#Seconds after the start of a flush past which no more attempts are made;
+#the batches left are dropped
+DEFAULT_FLUSH_DEADLINE = 30.0
+
+#Default number of threads used to send batches concurrently
+DEFAULT_MAX_WORKERS = 4
+
+#File the jsonl backend writes to when JSONL_OUTPUT is not set
+DEFAULT_JSONL_OUTPUT = 'metrics.jsonl'
+
+#Cloudwatch error codes that are worth retrying with the same batch
+RETRYABLE_ERROR_CODES = ('Throttling', 'ThrottlingException',
+    'RequestLimitExceeded', 'InternalServiceError', 'InternalFailure',
+    'ServiceUnavailable')
+
+#PutMetricData error codes caused by the content of the request, after
+#which the batch is split to isolate the datums at fault. Any other error,
+#such as AccessDenied or ExpiredToken, fails the whole batch.
+REJECTED_BATCH_ERROR_CODES = ('InvalidParameterValue', 'InvalidParameterCombination',
+    'MissingParameter', 'RequestEntityTooLarge')
+
+"""
+Build a single Cloudwatch metric datum. The datum has one dimension, plus
+any extra dimensions given as a list of {'Name': ..., 'Value': ...}.
+"""
+def create_datum(metric_name, dimension_name, dimension_value, value,
+    extra_dimensions=None):
+
+    return {
+        'MetricName': metric_name,
+        'Dimensions': [
+            {
+                'Name': dimension_name,
+                'Value': dimension_value
+            },
+        ] + list(extra_dimensions or []),
+        'Value': value
+    }
+
+"""
+Build a Cloudwatch metric datum from a metric_aggregator.StatisticSet.
+The datum carries Values/Counts arrays, from which Cloudwatch computes
+percentiles, when the set still has the count of each distinct value, and
+StatisticValues otherwise.
+"""
+def create_statistics_datum(metric_name, dimension_name, dimension_value,
+    statistics, extra_dimensions=None, unit=None):
+
+    datum = create_datum(metric_name, dimension_name, dimension_value, None,
+        extra_dimensions)
+    del datum['Value']
+    if statistics.values is not None:
+        values = sorted(statistics.values)
+        datum['Values'] = values
+        datum['Counts'] = [statistics.values[value] for value in values]
+    else:
+        datum['StatisticValues'] = statistics.statistic_values()
+    if unit is not None:
+        datum['Unit'] = unit
+    return datum
+
+"""
+Create a Cloudwatch client meant to be shared by every publishing thread.
+The connection pool is sized for the number of concurrent requests, calls
+time out after CLOUDWATCH_TIMEOUT seconds, and botocore's adaptive mode
+slows the client side request rate down when throttled. The client makes
+a single attempt per call by default, as MetricPublisher does the retrying.
+"""
+def create_cloudwatch_client(max_pool_connections=DEFAULT_MAX_WORKERS,
+    max_attempts=1):
+
+    client_config = boto_config('cloudwatch', max_attempts,
+        max_pool_connections=max_pool_connections)
+    return instrument_client(boto3.client('cloudwatch', config=client_config))
+
+"""
+Create the sink of one metrics backend:
+* cloudwatch - PutMetricData, using the PUBLISHER_MAX_WORKERS environment
+  variable for the number of batches sent concurrently. A value of 1 sends
+  batches one after another.
+* emf - Embedded Metric Format lines written to EMF_OUTPUT ('stdout', a
+  file path, or tcp://host:port / udp://host:port of the Cloudwatch agent)
+* prometheus - gauges served on http://0.0.0.0:PROMETHEUS_PORT/metrics
+* jsonl - one JSON object per metric written to JSONL_OUTPUT, with the
+  same choice of outputs as EMF_OUTPUT
+"""
+def create_sink(backend):
+    if backend == 'cloudwatch':
+        max_workers = int(os.environ.get('PUBLISHER_MAX_WORKERS', DEFAULT_MAX_WORKERS))
+        cloudwatch = create_cloudwatch_client(max_pool_connections=max_workers)
+        flush_deadline = float(os.environ.get('METRICS_FLUSH_DEADLINE', DEFAULT_FLUSH_DEADLINE))
+        return MetricPublisher(cloudwatch, max_workers=max_workers,
+            flush_deadline=flush_deadline)
+    if backend == 'emf':
+        return EMFPublisher(create_output(os.environ.get('EMF_OUTPUT', DEFAULT_OUTPUT)))
+    if backend == 'prometheus':
+        return PrometheusSink(int(os.environ.get('PROMETHEUS_PORT', DEFAULT_PROMETHEUS_PORT)))
+    if backend == 'jsonl':
+        return JsonLinesSink(create_output(os.environ.get('JSONL_OUTPUT', DEFAULT_JSONL_OUTPUT)))
+    raise Exception('Unknown METRICS_BACKEND: {}'.format(backend))
+
+"""
+Create the metric publisher of the METRICS_BACKEND environment variable, a
+comma separated list of backends (cloudwatch by default). Each backend
+sits behind its own QueuedSink, holding up to METRICS_MAX_BACKLOG metrics
+and flushed in the background at least every METRICS_FLUSH_INTERVAL
+seconds, so publishing never blocks a check. The publisher must be closed
+before the process exits for the last metrics to be sent.
+
+When METRICS_AGGREGATION_PERIOD is set, the samples of each metric are
+folded into one statistic set per that many seconds before they reach the
+backends, except for prometheus which only serves the latest values.
+"""
+def create_publisher():
+    max_backlog = int(os.environ.get('METRICS_MAX_BACKLOG', DEFAULT_MAX_BACKLOG))
+    flush_interval = float(os.environ.get('METRICS_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL))
+    aggregation_period = os.environ.get('METRICS_AGGREGATION_PERIOD')
+
+    sinks = []
+    for backend in os.environ.get('METRICS_BACKEND', 'cloudwatch').split(','):
+        sink = create_sink(backend.strip())
+        if aggregation_period and backend.strip() != 'prometheus':
+            sink = AggregatingSink(sink, float(aggregation_period))
+        sinks.append(QueuedSink(sink, max_backlog, flush_interval))
+    return sinks[0] if len(sinks) == 1 else FanoutSink(sinks)
+
+"""
+Buffers Cloudwatch metric datums and publishes them in batches.
+
+Metrics are added with put_metric and are only sent when flush is called.
+On flush, datums are grouped by namespace (sorted by namespace name) and
+sent with as few PutMetricData requests as the API allows. A batch that
+fails with a throttling or server error, or a timeout, is retried with
+jittered exponential backoff. A batch rejected by Cloudwatch as invalid is
+split in half and each half is retried, so a single bad datum does not drop
+the whole batch. Any other error, such as denied access or expired
+credentials, drops the batch after one attempt. Every failed attempt counts against the Cloudwatch circuit
+breaker; while it is open, batches are dropped without a call. No attempt
+is started once flush_deadline seconds have passed since the start of the
+flush, so a flush takes at most about that long plus one call timeout
+however unavailable Cloudwatch is.
+
+When max_workers is greater than 1, the batches of a flush are sent at
+the same time from a thread pool. The number of PutMetricData requests in
+flight is capped at max_in_flight (max_workers by default) across every
+thread using the publisher, to stay clear of Cloudwatch throttling.
+
+The publisher keeps counts of the datums published and the API calls made
+so that the number of calls saved over one call per datum can be reported.
+"""
+class MetricPublisher(object):
+    def __init__(self, cloudwatch, max_datums_per_request=MAX_DATUMS_PER_REQUEST,
+        max_attempts=MAX_ATTEMPTS, max_workers=1, max_in_flight=None,
+        flush_deadline=DEFAULT_FLUSH_DEADLINE):
+
+        self.cloudwatch = cloudwatch
+        self.max_datums_per_request = max_datums_per_request
+        self.max_attempts = max_attempts
+        self.flush_deadline = flush_deadline
+        self.max_workers = max_workers
+        self.in_flight = threading.BoundedSemaphore(max_in_flight or max_workers)
+        self.breaker = circuit_breaker('cloudwatch')
+        self.lock = threading.Lock()
+        self.executor = None
+        self.buffer = {}
+        self.datums_published = 0
+        self.datums_failed = 0
+        self.api_calls = 0
+
+    """
+    Add a metric datum to the buffer for the given namespace
+    """
+    def put_metric(self, namespace, metric_name, dimension_name,
+        dimension_value, value, extra_dimensions=None):
+
+        datum = create_datum(metric_name, dimension_name, dimension_value,
+            value, extra_dimensions)
+        with self.lock:
+            self.buffer.setdefault(namespace, []).append(datum)
+
+    """
+    Add a datum aggregating many samples, from a
+    metric_aggregator.StatisticSet, to the buffer for the given namespace
+    """
+    def put_statistics(self, namespace, metric_name, dimension_name,
+        dimension_value, statistics, extra_dimensions=None, unit=None):
+
+        datum = create_statistics_datum(metric_name, dimension_name,
+            dimension_value, statistics, extra_dimensions, unit)
+        with self.lock:
+            self.buffer.setdefault(namespace, []).append(datum)
+
+    """
+    Publish every buffered datum and empty the buffer. Returns once every
+    batch has been sent.
+    """
+    def flush(self):
+        with self.lock:
+            buffer = self.buffer
+            self.buffer = {}
+
+        deadline = time.monotonic() + self.flush_deadline
+        batches = []
+        for namespace in sorted(buffer):
+            datums = buffer[namespace]
+            for start in range(0, len(datums), self.max_datums_per_request):
+                batch = datums[start:start + self.max_datums_per_request]
+                batches.append((namespace, batch))
+
+        if self.max_workers > 1 and len(batches) > 1:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            futures = [self.executor.submit(self._publish_batch, namespace, batch, deadline)
+                for namespace, batch in batches]
+            for future in futures:
+                future.result()
+        else:
+            for namespace, batch in batches:
+                self._publish_batch(namespace, batch, deadline)
+
+    """
+    Shut down the thread pool used for concurrent publishing
+    """
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    """
+    Send one batch, retrying throttled requests and splitting rejected ones,
+    until the deadline (a time.monotonic value) has passed
+    """
+    def _publish_batch(self, namespace, batch, deadline):
+        for attempt in range(self.max_attempts):
+            if time.monotonic() >= deadline:
+                reason = 'flush deadline passed'
+                break
+            if not self.breaker.allow():
+                reason = 'circuit breaker {} is open'.format(self.breaker.name)
+                break
+            try:
+                self._count('api_calls', 1)
+                with self.in_flight:
+                    self.cloudwatch.put_metric_data(Namespace=namespace,
+                        MetricData=batch)
+                self.breaker.record_success()
+                self._count('datums_published', len(batch))
+                return
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+                if code in REJECTED_BATCH_ERROR_CODES or status == 413:
+                    #Cloudwatch answered, only the batch is at fault
+                    self.breaker.record_success()
+                    self._split_batch(namespace, batch, e, deadline)
+                    return
+                if code not in RETRYABLE_ERROR_CODES:
+                    self.breaker.record_failure()
+                    reason = 'PutMetricData failed: {}'.format(e)
+                    break
+            except BotoCoreError as e:
+                print("PutMetricData to namespace {} failed: {}".format(namespace, e))
+            self.breaker.record_failure()
+            reason = 'failed after {} attempts'.format(attempt + 1)
+            if attempt + 1 < self.max_attempts:
+                time.sleep(min(backoff_delay(attempt), max(0, deadline - time.monotonic())))
+
+        print("Dropping {} metrics to namespace {}: {}".format(len(batch), namespace, reason))
+        self._count('datums_failed', len(batch))
+
+    """
+    Retry each half of a rejected batch. A batch of one datum that is
+    rejected cannot be split further and is dropped.
+    """
+    def _split_batch(self, namespace, batch, error, deadline):
+        if len(batch) == 1:
+            print("Dropping rejected metric {} in namespace {}: {}".format(
+                batch[0]['MetricName'], namespace, error))
+            self._count('datums_failed', 1)
+            return
+
+        middle = len(batch) // 2
+        self._publish_batch(namespace, batch[:middle], deadline)
+        self._publish_batch(namespace, batch[middle:], deadline)
+
+    """
+    Increment one of the publishing counters from any thread
+    """
+    def _count(self, counter, amount):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    """
+    Number of PutMetricData calls avoided compared to one call per datum
+    """
+    def calls_saved(self):
+        return max(0, self.datums_published + self.datums_failed - self.api_calls)
+
+    """
+    Print a one line summary of the publishing activity
+    """
+    def report(self):
+        print("Published {} metrics ({} failed) in {} API calls, saving {} calls".format(
+            self.datums_published, self.datums_failed, self.api_calls,
+            self.calls_saved()))
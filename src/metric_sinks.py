@@ -0,0 +1,426 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from metric_aggregator import MetricAggregator
+
+"""
+Metric sinks. A sink is any object with the interface of MetricPublisher:
+
+* put_metric(namespace, metric_name, dimension_name, dimension_value,
+  value, extra_dimensions=None) - record one metric
+* put_statistics(namespace, metric_name, dimension_name, dimension_value,
+  statistics, extra_dimensions=None, unit=None) - record a
+  metric_aggregator.StatisticSet summarizing many samples
+* flush() - send what was recorded
+* close() - send anything left and release resources
+* report() - print a one line summary of the activity
+
+MetricPublisher (Cloudwatch) and EMFPublisher are sinks; this module adds
+newline-JSON and Prometheus sinks, QueuedSink to take any sink off the
+caller's thread, AggregatingSink to fold samples into statistic sets,
+ChangeOnlySink to skip gauges that did not change, and FanoutSink to write
+to several sinks at once.
+"""
+
+#Number of metrics a QueuedSink holds before new metrics are dropped
+DEFAULT_MAX_BACKLOG = 50000
+
+#Seconds between two flushes of a QueuedSink when flush is not called
+DEFAULT_FLUSH_INTERVAL = 10.0
+
+#Seconds the background flusher waits for a metric before checking whether
+#a flush is due
+FLUSHER_POLL = 0.1
+
+#Port of the Prometheus /metrics endpoint
+DEFAULT_PROMETHEUS_PORT = 9108
+
+#Seconds after which a ChangeOnlySink publishes a gauge that did not change
+DEFAULT_HEARTBEAT = 900
+
+#Number of heartbeats after which a gauge no longer recorded, for instance
+#that of a deleted deployment, is removed from the state file
+STATE_EXPIRY_HEARTBEATS = 4
+
+def dimensions_dict(dimension_name, dimension_value, extra_dimensions=None):
+    dimensions = {dimension_name: dimension_value}
+    for dimension in extra_dimensions or []:
+        dimensions[dimension['Name']] = dimension['Value']
+    return dimensions
+
+"""
+Writes each metric as one JSON object per line to an output of
+emf_publisher.create_output (stdout, a file or a socket)
+"""
+class JsonLinesSink(object):
+    def __init__(self, output):
+        self.output = output
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.datums_published = 0
+
+    def put_metric(self, namespace, metric_name, dimension_name,
+        dimension_value, value, extra_dimensions=None):
+
+        record = {
+            'timestamp': time.time(),
+            'namespace': namespace,
+            'metric_name': metric_name,
+            'dimensions': dimensions_dict(dimension_name, dimension_value, extra_dimensions),
+            'value': value
+        }
+        with self.lock:
+            self.buffer.append(record)
+
+    def put_statistics(self, namespace, metric_name, dimension_name,
+        dimension_value, statistics, extra_dimensions=None, unit=None):
+
+        record = {
+            'timestamp': time.time(),
+            'namespace': namespace,
+            'metric_name': metric_name,
+            'dimensions': dimensions_dict(dimension_name, dimension_value, extra_dimensions),
+            'statistics': statistics.statistic_values(),
+            'unit': unit
+        }
+        with self.lock:
+            self.buffer.append(record)
+
+    def flush(self):
+        with self.lock:
+            buffer = self.buffer
+            self.buffer = []
+
+        if buffer:
+            self.output.write(''.join(json.dumps(r) + '\n' for r in buffer))
+            self.datums_published += len(buffer)
+
+    def close(self):
+        self.flush()
+        self.output.close()
+
+    def report(self):
+        print("Wrote {} metrics as JSON lines".format(self.datums_published))
+
+"""
+Replace the characters Prometheus does not accept in metric and label names
+"""
+def prometheus_name(name):
+    name = re.sub(r'[^a-zA-Z0-9_]', '_', name)
+    return '_' + name if name[:1].isdigit() else name
+
+def prometheus_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+"""
+Keeps the last value of every metric and serves them as Prometheus gauges on
+http://<host>:<port>/metrics, so that the health metrics can be scraped
+locally at any frequency without Cloudwatch costs. The Prometheus metric
+name is the namespace and metric name joined by an underscore, and the
+dimensions become labels.
+"""
+class PrometheusSink(object):
+    def __init__(self, port=DEFAULT_PROMETHEUS_PORT, host=''):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.scrapes = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _handler_class(self):
+        sink = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = sink.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return MetricsHandler
+
+    def put_metric(self, namespace, metric_name, dimension_name,
+        dimension_value, value, extra_dimensions=None):
+
+        name = prometheus_name('{}_{}'.format(namespace, metric_name))
+        labels = tuple(sorted((prometheus_name(k), v) for k, v in
+            dimensions_dict(dimension_name, dimension_value, extra_dimensions).items()))
+        with self.lock:
+            self.values[(name, labels)] = value
+
+    """
+    Serve the count, sum, minimum and maximum of the samples as gauges with
+    the _count, _sum, _min and _max suffixes
+    """
+    def put_statistics(self, namespace, metric_name, dimension_name,
+        dimension_value, statistics, extra_dimensions=None, unit=None):
+
+        for suffix, value in [('_count', statistics.sample_count), ('_sum', statistics.sum),
+            ('_min', statistics.minimum), ('_max', statistics.maximum)]:
+            self.put_metric(namespace, metric_name + suffix, dimension_name,
+                dimension_value, value, extra_dimensions)
+
+    """
+    Render every metric in the Prometheus text exposition format
+    """
+    def exposition(self):
+        with self.lock:
+            values = sorted(self.values.items())
+            self.scrapes += 1
+
+        lines = []
+        previous = None
+        for (name, labels), value in values:
+            if name != previous:
+                lines.append('# TYPE {} gauge'.format(name))
+                previous = name
+            label_text = ','.join('{}="{}"'.format(k, prometheus_label_value(v))
+                for k, v in labels)
+            lines.append('{}{{{}}} {}'.format(name, label_text, float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def report(self):
+        print("Serving {} metrics for Prometheus, scraped {} times".format(
+            len(self.values), self.scrapes))
+
+"""
+Puts a sink behind a bounded in-memory queue emptied by a background
+thread, so that put_metric and flush never block the health checks on the
+sink. put_metric only enqueues; when the backlog holds max_backlog metrics,
+new metrics are dropped and counted. flush asks the background thread to
+flush the sink once the queue is drained. The sink is also flushed every
+flush_interval seconds whether the queue is drained or not, so a steady
+stream of metrics cannot hold them back. close drains the queue, flushes
+and closes the sink, and must be called before a short-lived process exits.
+"""
+class QueuedSink(object):
+    def __init__(self, sink, max_backlog=DEFAULT_MAX_BACKLOG,
+        flush_interval=DEFAULT_FLUSH_INTERVAL):
+
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_backlog)
+        self.flush_requested = threading.Event()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.datums_dropped = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put_metric(self, *args, **kwargs):
+        self._enqueue('put_metric', args, kwargs)
+
+    def put_statistics(self, *args, **kwargs):
+        self._enqueue('put_statistics', args, kwargs)
+
+    def _enqueue(self, method, args, kwargs):
+        try:
+            self.queue.put_nowait((method, args, kwargs))
+        except queue.Full:
+            with self.lock:
+                self.datums_dropped += 1
+
+    def flush(self):
+        self.flush_requested.set()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                method, args, kwargs = self.queue.get(timeout=FLUSHER_POLL)
+            except queue.Empty:
+                args = None
+
+            if args is not None:
+                try:
+                    getattr(self.sink, method)(*args, **kwargs)
+                except Exception as e:
+                    print("Failed to record metric {}: {!r}".format(args[1], e))
+
+            drained = self.queue.empty()
+            requested = self.flush_requested.is_set() or self.stopping.is_set()
+            if (requested and drained) or time.monotonic() - last_flush >= self.flush_interval:
+                if drained:
+                    self.flush_requested.clear()
+                try:
+                    self.sink.flush()
+                except Exception as e:
+                    print("Failed to flush metrics: {!r}".format(e))
+                last_flush = time.monotonic()
+                if drained and self.stopping.is_set():
+                    return
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        self.sink.close()
+
+    def report(self):
+        if self.datums_dropped:
+            print("Dropped {} metrics, backlog full".format(self.datums_dropped))
+        self.sink.report()
+
+"""
+Folds the samples recorded with put_metric into one StatisticSet per
+(namespace, metric, dimensions) and hands the sets to the wrapped sink once
+per period, so that checks run many times a minute cost one datum per
+metric and period. Cloudwatch keeps the SampleCount of each datum, which
+the uptime calculations use to stay correct at any check frequency.
+Statistic sets recorded with put_statistics are passed through.
+"""
+class AggregatingSink(object):
+    def __init__(self, sink, period):
+        self.sink = sink
+        self.aggregator = MetricAggregator(sink, period)
+
+    def put_metric(self, namespace, metric_name, dimension_name,
+        dimension_value, value, extra_dimensions=None):
+
+        self.aggregator.add(namespace, metric_name, dimension_name,
+            dimension_value, value, extra_dimensions)
+
+    def put_statistics(self, *args, **kwargs):
+        self.sink.put_statistics(*args, **kwargs)
+
+    def flush(self):
+        self.aggregator.flush()
+        self.sink.flush()
+
+    def close(self):
+        self.aggregator.close()
+        self.sink.flush()
+        self.sink.close()
+
+    def report(self):
+        self.sink.report()
+
+"""
+Publishes the gauges recorded with one of the given dimension names only
+when their value changed since they were last published, or when heartbeat
+seconds have passed, and passes every other metric through. The last
+published value and time of each gauge are kept in a JSON state file, read
+when the sink is created and written on flush and close when it changed, so
+that short-lived processes started every minute share the state.
+
+A gauge is considered published once it is handed to the wrapped sink; if
+that publish fails, the gauge is sent again at the latest after the next
+heartbeat. Metrics that must stay dense, such as the health checks the
+uptime report counts, must not use one of the dimension names.
+"""
+class ChangeOnlySink(object):
+    def __init__(self, sink, state_path, dimension_names, heartbeat=DEFAULT_HEARTBEAT):
+        self.sink = sink
+        self.state_path = state_path
+        self.dimension_names = set(dimension_names)
+        self.heartbeat = heartbeat
+        self.lock = threading.Lock()
+        self.state = self._load()
+        self.changed = False
+        self.datums_skipped = 0
+
+    def _load(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            if os.path.exists(self.state_path):
+                print("Ignoring unreadable gauge state {}: {}".format(self.state_path, e))
+            return {}
+
+    def _save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            expiry = time.time() - STATE_EXPIRY_HEARTBEATS * self.heartbeat
+            self.state = dict((key, entry) for key, entry in self.state.items()
+                if entry[1] >= expiry)
+            state = dict(self.state)
+            self.changed = False
+
+        temporary_path = self.state_path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temporary_path, self.state_path)
+
+    def put_metric(self, namespace, metric_name, dimension_name,
+        dimension_value, value, extra_dimensions=None):
+
+        if dimension_name in self.dimension_names:
+            key = '|'.join([namespace, metric_name, dimension_name, dimension_value]
+                + ['{}={}'.format(d['Name'], d['Value']) for d in extra_dimensions or []])
+            now = time.time()
+            with self.lock:
+                entry = self.state.get(key)
+                if entry is not None and entry[0] == value and now - entry[1] < self.heartbeat:
+                    self.datums_skipped += 1
+                    return
+                self.state[key] = [value, now]
+                self.changed = True
+
+        self.sink.put_metric(namespace, metric_name, dimension_name,
+            dimension_value, value, extra_dimensions)
+
+    def put_statistics(self, *args, **kwargs):
+        self.sink.put_statistics(*args, **kwargs)
+
+    def flush(self):
+        self.sink.flush()
+        self._save()
+
+    def close(self):
+        self.sink.close()
+        self._save()
+
+    def report(self):
+        print("Skipped {} unchanged gauges".format(self.datums_skipped))
+        self.sink.report()
+
+"""
+Writes every metric to each of several sinks
+"""
+class FanoutSink(object):
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def put_metric(self, *args, **kwargs):
+        for sink in self.sinks:
+            sink.put_metric(*args, **kwargs)
+
+    def put_statistics(self, *args, **kwargs):
+        for sink in self.sinks:
+            sink.put_statistics(*args, **kwargs)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def report(self):
+        for sink in self.sinks:
+            sink.report()
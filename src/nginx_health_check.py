@@ -5,41 +5,58 @@ import requests
 import requests
 import datetime
 import os
+import time
+from metric_aggregator import MetricAggregator, record_probe_timings
+from metric_publisher import create_publisher
+from resilience import CircuitOpenError, circuit_breaker
+from self_metrics import count, run_instrumented, stage
+
+#Seconds to wait for the HEAD request before counting NGINX as down
+REQUEST_TIMEOUT = 10.0
 
 
 """
-Wrapper to call Cloudwatch put metric function
+Wrapper to add a metric to the batched Cloudwatch metric publisher
 """
-def put_metric_data_wrapper(cloudwatch, namespace, metric_name, dim_name, dim_value, value):
-    cloudwatch.put_metric_data(
-        Namespace=namespace,
-        MetricData=[
-            {
-                'MetricName': metric_name,
-                'Dimensions': [
-                    {
-                        'Name': dim_name,
-                        'Value': dim_value
-                    },
-                ],
-                'Value': value
-            },
-        ]
-    )
+def put_metric_data_wrapper(publisher, namespace, metric_name, dim_name, dim_value, value):
+    publisher.put_metric(namespace, metric_name, dim_name, dim_value, value)
 
 
 """
 Checks response status of HEAD request
 If a 302 response status is received, record a value of 1.0 in cloudwatch
 Else, record a value of 0.0 in cloudwatch
+A request that fails or takes longer than timeout seconds counts as down
+While the circuit breaker of the endpoint is open no request is made and
+the endpoint counts as down
+When an aggregator is given, the time to the response headers, the total
+time and the response size are added to it as probe_* samples
 """
-def test_nginx_redirect(url):
-    cloudwatch = boto3.client('cloudwatch')
-    response = requests.head(url)
+def test_nginx_redirect(url, publisher, timeout=REQUEST_TIMEOUT, timings=None):
+    try:
+        start = time.perf_counter()
+        with stage('nginx_request'):
+            response = circuit_breaker('http:nginx').call(requests.head, url, timeout=timeout)
+        status_code = response.status_code
+        count('http_bytes_received', len(response.content))
+        if timings is not None:
+            record_probe_timings(timings, 'nginx', 'HealthCheck', 'NginxRedirect',
+                {'time_to_first_byte': 1000 * response.elapsed.total_seconds(),
+                 'total_time': 1000 * (time.perf_counter() - start)},
+                len(response.content))
+    except CircuitOpenError as e:
+        print("Skipping HEAD request: " + str(e))
+        put_metric_data_wrapper(publisher, 'nginx', 'nginx_redirect_health_check',
+            'HealthCheck', 'NginxRedirect', 0.0)
+        return
+    except requests.exceptions.RequestException as e:
+        print("HEAD request failed: " + str(e))
+        status_code = None
+    count('http_requests')
 	
-    if response.status_code == 302:
+    if status_code == 302:
         put_metric_data_wrapper(
-                                    cloudwatch, 
+                                    publisher, 
                                     'nginx', 
                                     'nginx_redirect_health_check', 
                                     'HealthCheck', 
@@ -47,9 +64,9 @@ def test_nginx_redirect(url):
                                     1.0
                                 )
     else:
-        print("HEAD request returned a non-302 status code: " + str(response.status_code))
+        print("HEAD request returned a non-302 status code: " + str(status_code))
         put_metric_data_wrapper(
-                                    cloudwatch, 
+                                    publisher, 
                                     'nginx', 
                                     'nginx_redirect_health_check', 
                                     'HealthCheck', 
@@ -64,12 +81,17 @@ def main():
     except:		
         raise Exception('Missing environment variable: WHTOOLS_URL')
 	
-    test_nginx_redirect(whtools_url)
+    publisher = create_publisher()
+    timings = MetricAggregator(publisher)
+    test_nginx_redirect(whtools_url, publisher, timings=timings)
+    with stage('publish'):
+        timings.close()
+        publisher.close()
 	
 
 	
 if __name__ == '__main__':
-    main()
+    run_instrumented(main, 'nginx_health_check')
 
 
     
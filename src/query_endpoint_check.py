@@ -3,48 +3,68 @@ import boto3
 import requests
 import json
 import os
+import time
+from metric_aggregator import MetricAggregator, record_probe_timings
+from metric_publisher import create_publisher
+from resilience import CircuitOpenError, circuit_breaker
+from self_metrics import count, run_instrumented, stage
+
+#Seconds to wait for the query response before counting the endpoint as down
+REQUEST_TIMEOUT = 30.0
 
 """
-Wrapper to call Cloudwatch put metric function
+Wrapper to add a metric to the batched Cloudwatch metric publisher
 """
-def put_metric_wrapper(cloudwatch, namespace, metric_name, dim_name, dim_value, value):
-    cloudwatch.put_metric_data(
-        Namespace=namespace,
-        MetricData=[
-            {
-                'MetricName': metric_name,
-                'Dimensions': [
-                    {
-                        'Name': dim_name,
-                        'Value': dim_value
-                    },
-                ],
-                'Value': value
-            },
-        ]
-    )
+def put_metric_wrapper(publisher, namespace, metric_name, dim_name, dim_value, value):
+    publisher.put_metric(namespace, metric_name, dim_name, dim_value, value)
 
 
 """
 Send POST request to Query endpoint
 """
-def send_post_request(url, json_data, username, password, headers):
-    return requests.post(url, data=json_data, auth=(username, password), headers=headers)
+def send_post_request(url, json_data, username, password, headers,
+    timeout=REQUEST_TIMEOUT):
+    return requests.post(url, data=json_data, auth=(username, password), headers=headers,
+        timeout=timeout)
 
 
 """
 Checks response status of POST request to Query endpoint
 If an 200 response status is received, record a value of 1.0 in cloudwatch
 Else, record a value of 0.0 in cloudwatch
+A request that fails or times out counts as down
+While the circuit breaker of the endpoint is open no request is made and
+the endpoint counts as down
+When an aggregator is given, the time to the response headers, the total
+time and the response size are added to it as probe_* samples
 """
-def check_query_endpoint(url, json_data, username, password):
-    response=send_post_request(url, json_data, username, password, {'content-type':'application/json'})
-	
-    cloudwatch = boto3.client('cloudwatch')	
+def check_query_endpoint(url, json_data, username, password, publisher, timings=None):
+    try:
+        start = time.perf_counter()
+        with stage('query_request'):
+            response=circuit_breaker('http:query-endpoint').call(send_post_request, url,
+                json_data, username, password, {'content-type':'application/json'})
+        status_code = response.status_code
+        count('http_bytes_sent', len(json_data))
+        count('http_bytes_received', len(response.content))
+        if timings is not None:
+            record_probe_timings(timings, 'query-endpoint', 'HealthCheck', 'QueryEndpoint',
+                {'time_to_first_byte': 1000 * response.elapsed.total_seconds(),
+                 'total_time': 1000 * (time.perf_counter() - start)},
+                len(response.content))
+    except CircuitOpenError as e:
+        print("Skipping POST request: " + str(e))
+        put_metric_wrapper(publisher, 'query-endpoint', 'query_endpoint_check',
+            'HealthCheck', 'QueryEndpoint', 0.0)
+        return
+    except requests.exceptions.RequestException as e:
+        print("POST request failed: " + str(e))
+        status_code = None
+    count('http_requests')
 	
-    if response.status_code == 200:
+    if status_code == 200:
         put_metric_wrapper(
-		                    cloudwatch, 
+		                    publisher, 
                             'query-endpoint', 
                             'query_endpoint_check', 
                             'HealthCheck', 
@@ -52,9 +72,9 @@ def check_query_endpoint(url, json_data, username, password):
                             1.0
                           )
     else:
-        print("POST request returned a non-200 status code: " + str(response.status_code))
+        print("POST request returned a non-200 status code: " + str(status_code))
         put_metric_wrapper(
-		                    cloudwatch, 
+		                    publisher, 
                             'query-endpoint', 
                             'query_endpoint_check', 
                             'HealthCheck', 
@@ -62,15 +82,10 @@ def check_query_endpoint(url, json_data, username, password):
                             0.0
                           )
 	
-def main():
-    try:
-        username = os.environ["USERNAME"]
-        password = os.environ["PASSWORD"]
-        query_url = os.environ['QUERY_URL']
-    except:
-        raise Exception('Missing environment variable: USERNAME, PASSWORD, or QUERY_URL')
-	
-	
+"""
+Build the JSON body of the query sent to the Query endpoint
+"""
+def create_query_json():
     raw_query = {
         "systemQueryName": "SDW 2.3",
         "resultEncoding": "hex",
@@ -89,10 +104,28 @@ def main():
         "endDate": "2014-09-19T14:45:07.609Z",
         "endDateOperator": "LTE"
     }
-    query_as_json=json.dumps(raw_query)
+    return json.dumps(raw_query)
+
+
+def main():
+    try:
+        username = os.environ["USERNAME"]
+        password = os.environ["PASSWORD"]
+        query_url = os.environ['QUERY_URL']
+    except:
+        raise Exception('Missing environment variable: USERNAME, PASSWORD, or QUERY_URL')
+	
+	
+    query_as_json=create_query_json()
 	
-    check_query_endpoint(query_url, query_as_json, username, password)
+    publisher = create_publisher()
+    timings = MetricAggregator(publisher)
+    check_query_endpoint(query_url, query_as_json, username, password, publisher,
+        timings=timings)
+    with stage('publish'):
+        timings.close()
+        publisher.close()
 
 
 if __name__ == '__main__':
-    main()
+    run_instrumented(main, 'query_endpoint_check')
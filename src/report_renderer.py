@@ -0,0 +1,216 @@
+import csv
+import html
+import json
+import math
+
+#Size in bytes of the parts of a multipart upload. S3 requires at least
+#5 MB for every part but the last.
+PART_SIZE = 8 * 1024 * 1024
+
+#Seconds for which the report links sent in the summary stay valid
+LINK_EXPIRY = 7 * 86400
+
+#Columns of the JSON and CSV reports, in order
+COLUMNS = ['window', 'window_start', 'window_end', 'resource', 'label',
+    'namespace', 'metric_name', 'uptime', 'coverage', 'unknown', 'downtime',
+    'uptime_lower_bound']
+
+#Content type of each rendered format
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'csv': 'text/csv',
+    'html': 'text/html'
+}
+
+#Number of lowest uptimes listed per window in the summary
+SUMMARY_LOWEST = 5
+
+"""
+A named time range of the report
+"""
+class ReportWindow(object):
+    def __init__(self, name, start_time, end_time):
+        self.name = name
+        self.start_time = start_time
+        self.end_time = end_time
+
+def format_time(time):
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+"""
+Percentages are NaN for a resource that was never observed; they are
+rendered as null/empty rather than as an invalid JSON number
+"""
+def clean_value(value):
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+def format_percent(value):
+    value = clean_value(value)
+    return '-' if value is None else '{:.3f}'.format(value)
+
+"""
+Yield one flat dictionary with the COLUMNS keys per window and resource.
+window_uptimes is a list of (window, uptimes) tuples, uptimes being the
+list of (resource, result) tuples of uptime.collect_uptimes.
+"""
+def report_rows(window_uptimes):
+    for window, uptimes in window_uptimes:
+        for resource, result in uptimes:
+            row = {
+                'window': window.name,
+                'window_start': window.start_time.isoformat(),
+                'window_end': window.end_time.isoformat(),
+                'resource': resource.name,
+                'label': resource.label,
+                'namespace': resource.namespace,
+                'metric_name': resource.metric_name
+            }
+            for name in COLUMNS[7:]:
+                row[name] = clean_value(result.get(name))
+            yield row
+
+"""
+Write the report as one JSON document to a text stream, a row at a time
+"""
+def render_json(window_uptimes, stream, generated_time):
+    stream.write('{{"generated": {}, "columns": {}, "results": ['.format(
+        json.dumps(generated_time.isoformat()), json.dumps(COLUMNS)))
+    for index, row in enumerate(report_rows(window_uptimes)):
+        stream.write((',\n' if index else '\n') + json.dumps(row))
+    stream.write('\n]}\n')
+
+"""
+Write the report as CSV with a header row to a text stream
+"""
+def render_csv(window_uptimes, stream, generated_time):
+    writer = csv.DictWriter(stream, COLUMNS)
+    writer.writeheader()
+    for row in report_rows(window_uptimes):
+        writer.writerow(row)
+
+"""
+Write an HTML page with one table per window to a text stream
+"""
+def render_html(window_uptimes, stream, generated_time):
+    stream.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+        '<title>Uptime Report</title></head><body>\n'
+        '<h1>Uptime Report</h1>\n<p>Generated {}</p>\n'.format(format_time(generated_time)))
+    for window, uptimes in window_uptimes:
+        stream.write('<h2>{}: {} &mdash; {}</h2>\n<table>\n'
+            '<tr><th>Resource</th><th>Uptime (%)</th><th>Observed (%)</th>'
+            '<th>Unknown (%)</th><th>Downtime (%)</th></tr>\n'.format(
+            html.escape(window.name), format_time(window.start_time),
+            format_time(window.end_time)))
+        for resource, result in uptimes:
+            stream.write('<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n'.format(
+                html.escape(resource.label), format_percent(result['uptime']),
+                format_percent(result['coverage']), format_percent(result['unknown']),
+                format_percent(result['downtime'])))
+        stream.write('</table>\n')
+    stream.write('</body></html>\n')
+
+RENDERERS = {
+    'json': render_json,
+    'csv': render_csv,
+    'html': render_html
+}
+
+"""
+Text stream that uploads what is written to it to S3 with a multipart
+upload, one part every part_size bytes, so that a report of any size is
+never held in memory whole. A stream closed before reaching part_size is
+uploaded with a single PutObject. The upload is aborted when abort is
+called or the stream is left with an exception.
+"""
+class S3MultipartWriter(object):
+    def __init__(self, s3, bucket, key, content_type, part_size=PART_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+
+    def write(self, text):
+        self.buffer.extend(text.encode('utf-8'))
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket,
+                Key=self.key, ContentType=self.content_type)['UploadId']
+
+        number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key,
+            UploadId=self.upload_id, PartNumber=number, Body=data)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+
+    def close(self):
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key,
+                Body=bytes(self.buffer), ContentType=self.content_type)
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+"""
+Render the report in every format straight to S3 under
+prefix/<generated time>/uptime.<format> and return a dictionary of a
+presigned link to each artifact by format
+"""
+def archive_report(s3, bucket, prefix, window_uptimes, generated_time,
+    formats=('json', 'csv', 'html'), link_expiry=LINK_EXPIRY):
+    links = {}
+    folder = prefix + generated_time.strftime('%Y-%m-%dT%H%M%S')
+    for report_format in formats:
+        key = '{}/uptime.{}'.format(folder, report_format)
+        with S3MultipartWriter(s3, bucket, key, CONTENT_TYPES[report_format]) as writer:
+            RENDERERS[report_format](window_uptimes, writer, generated_time)
+        links[report_format] = s3.generate_presigned_url('get_object',
+            Params={'Bucket': bucket, 'Key': key}, ExpiresIn=link_expiry)
+    return links
+
+"""
+Build the short summary sent through SNS when the full report is archived:
+the number of resources and the lowest uptimes of each window, followed by
+the links to the full report
+"""
+def create_summary_message(window_uptimes, links):
+    message = "Uptime report summary. The full report is available at:\n\n"
+    for report_format in sorted(links):
+        message += "\t{}: {}\n".format(report_format.upper(), links[report_format])
+
+    for window, uptimes in window_uptimes:
+        observed = [(resource, result) for resource, result in uptimes
+            if clean_value(result['uptime']) is not None]
+        lowest = sorted(observed, key=lambda item: item[1]['uptime'])[:SUMMARY_LOWEST]
+        message += "\n*****{}: {} --- {}*****\n\n\t{} resources, {} never observed\n".format(
+            window.name, format_time(window.start_time), format_time(window.end_time),
+            len(uptimes), len(uptimes) - len(observed))
+        for resource, result in lowest:
+            message += "\t{}: {}\n".format(resource.label, format_percent(result['uptime']))
+
+    return message
@@ -0,0 +1,182 @@
+import os
+import random
+import threading
+import time
+from botocore.config import Config
+from self_metrics import count
+
+#Seconds to wait for a dependency before giving up on a call, unless the
+#<NAME>_TIMEOUT environment variable (e.g. KUBERNETES_TIMEOUT) is set
+DEFAULT_TIMEOUTS = {
+    'kubernetes': 20.0,
+    'cloudwatch': 10.0,
+    'sns': 10.0,
+    's3': 30.0
+}
+
+#Number of attempts of a call failing with a transient error
+DEFAULT_ATTEMPTS = 3
+
+#Base and maximum delay in seconds of the backoff between attempts
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 10.0
+
+#Consecutive failures after which a circuit breaker opens, unless the
+#CIRCUIT_FAILURE_THRESHOLD environment variable is set
+FAILURE_THRESHOLD = 5
+
+#Seconds an open circuit breaker rejects calls before letting one through,
+#unless the CIRCUIT_RESET_TIMEOUT environment variable is set
+RESET_TIMEOUT = 60.0
+
+def dependency_timeout(name):
+    return float(os.environ.get(name.upper() + '_TIMEOUT', DEFAULT_TIMEOUTS[name]))
+
+"""
+Delay before the attempt following attempt (0 for the first), drawn
+uniformly up to the exponential backoff ("full jitter") so that clients
+failing together do not retry together
+"""
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+"""
+Call function until it returns, retrying the exceptions for which
+retryable returns True with a jittered exponential backoff. The last
+exception is raised once attempts calls have failed.
+"""
+def call_with_retries(function, retryable, attempts=DEFAULT_ATTEMPTS):
+    for attempt in range(attempts):
+        try:
+            return function()
+        except Exception as e:
+            if attempt + 1 == attempts or not retryable(e):
+                raise
+            count('retries')
+            time.sleep(backoff_delay(attempt))
+
+"""
+Configuration of a boto3 client of a dependency, with its connect and read
+timeouts and botocore's adaptive retry mode. max_attempts counts every
+attempt of a call, the first one included; 1 leaves retries to the caller.
+"""
+def boto_config(name, max_attempts=DEFAULT_ATTEMPTS, **kwargs):
+    timeout = dependency_timeout(name)
+    return Config(connect_timeout=timeout, read_timeout=timeout,
+        retries={'total_max_attempts': max_attempts, 'mode': 'adaptive'}, **kwargs)
+
+"""
+Hold one of the semaphore's slots during every call of a boto3 client, so
+that the clients sharing the semaphore, for instance those of one AWS
+account, never make more concurrent calls than it allows
+"""
+def limit_concurrent_calls(aws_client, semaphore):
+    events = aws_client.meta.events
+
+    def acquire(**kwargs):
+        semaphore.acquire()
+
+    def release(**kwargs):
+        semaphore.release()
+
+    events.register('before-call', acquire)
+    events.register('after-call', release)
+    events.register('after-call-error', release)
+    return aws_client
+
+"""
+Raised instead of calling a dependency whose circuit breaker is open
+"""
+class CircuitOpenError(Exception):
+    pass
+
+"""
+Circuit breaker of one dependency. After failure_threshold consecutive
+failures the breaker opens and allow returns False at once, so callers
+skip the dependency instead of waiting for it to time out. Once
+reset_timeout seconds have passed a single call is let through (half
+open): its success closes the breaker, its failure opens it again.
+"""
+class CircuitBreaker(object):
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD,
+        reset_timeout=RESET_TIMEOUT):
+
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    """
+    Whether a call may be made now. Never blocks.
+    """
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running or time.monotonic() - self.opened_at < self.reset_timeout:
+                count('circuit_rejections')
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print("Circuit breaker {} opened after {} failures".format(
+                        self.name, self.failures))
+                self.opened_at = time.monotonic()
+                self.trial_running = False
+
+    """
+    Call function through the breaker, raising CircuitOpenError when it is
+    open
+    """
+    def call(self, function, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError('Circuit breaker {} is open'.format(self.name))
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+"""
+Return the circuit breaker of the named dependency, shared by every thread
+of the process
+"""
+def circuit_breaker(name):
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name,
+                int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', FAILURE_THRESHOLD)),
+                float(os.environ.get('CIRCUIT_RESET_TIMEOUT', RESET_TIMEOUT)))
+        return breaker
+
+"""
+Record that a check could not be made, instead of a health metric. The
+health series then has no datum for the check, which the uptime report
+counts as unknown rather than down, and check_unknown marks the gap.
+"""
+def record_unknown(publisher, namespace, dimension_name, dimension_value,
+    extra_dimensions=None):
+
+    count('checks_unknown')
+    publisher.put_metric(namespace, 'check_unknown', dimension_name,
+        dimension_value, 1.0, extra_dimensions)
@@ -0,0 +1,97 @@
+import json
+import os
+
+#Catalog used when the RESOURCE_CATALOG environment variable is not set
+DEFAULT_CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'resources.json')
+
+#Metric name suffix and dimension value suffix of the health metric that
+#kubernetes_health_check.py records for each kind of workload
+KUBERNETES_KINDS = {
+    'deployment': ('_deployment_health_check', 'DeploymentHealthCheck'),
+    'statefulset': ('_statefulset_health_check', 'StatefulSetHealthCheck')
+}
+
+"""
+Concatenate the name and suffix
+"""
+def create_metric_name(name, suffix):
+    return name + suffix
+
+"""
+Create a dimension value by capitalizing the first letter of the base name
+and then appending the suffix. For instance base=mybase, suffix=MySuffix
+results in MybaseMySuffix.
+"""
+def create_dimension_value(name, suffix):
+    return str.upper(name[0]) + name[1:] + suffix
+
+"""
+A monitored resource and the Cloudwatch health metric recorded for it.
+The metric has value 1 when the resource is up and 0 when it is down.
+"""
+class Resource(object):
+    def __init__(self, name, label, namespace, metric_name, dimension_value,
+        dimension_name='HealthCheck', kind=None, extra_dimensions=None,
+        probe=None):
+
+        self.name = name
+        self.label = label
+        self.namespace = namespace
+        self.metric_name = metric_name
+        self.dimension_name = dimension_name
+        self.dimension_value = dimension_value
+        self.kind = kind
+        self.extra_dimensions = extra_dimensions or []
+        self.probe = probe
+
+    """
+    All the dimensions of the health metric
+    """
+    def dimensions(self):
+        return [
+            {
+                'Name': self.dimension_name,
+                'Value': self.dimension_value
+            },
+        ] + self.extra_dimensions
+
+    """
+    Create a resource from a catalog entry. For the 'deployment' and
+    'statefulset' kinds the namespace, metric name and dimension value are
+    derived from the workload name the same way the Kubernetes health check
+    creates them, so only the name is required. Other resources give their
+    metric explicitly. The label shown in reports defaults to the name in
+    upper case.
+    """
+    @classmethod
+    def from_config(cls, entry):
+        entry = dict(entry)
+        name = entry['name']
+        kind = entry.get('kind')
+        entry.setdefault('label', name.upper())
+
+        if kind in KUBERNETES_KINDS:
+            metric_suffix, dimension_suffix = KUBERNETES_KINDS[kind]
+            entry.setdefault('namespace', 'k8s-metrics')
+            entry.setdefault('metric_name', create_metric_name(name, metric_suffix))
+            entry.setdefault('dimension_value', create_dimension_value(name, dimension_suffix))
+
+        return cls(**entry)
+
+"""
+Load the resources of a catalog file. The path defaults to the
+RESOURCE_CATALOG environment variable, then to resources.json at the root
+of the repository.
+"""
+def load_catalog(path=None):
+    path = path or os.environ.get('RESOURCE_CATALOG', DEFAULT_CATALOG)
+    with open(path) as f:
+        catalog = json.load(f)
+
+    return [Resource.from_config(entry) for entry in catalog['resources']]
+
+"""
+Return the resources that are checked with an HTTP probe
+"""
+def probe_resources(resources):
+    return [resource for resource in resources if resource.probe is not None]
@@ -0,0 +1,191 @@
+import bisect
+import cProfile
+import os
+import threading
+import time
+from contextlib import contextmanager
+from metric_aggregator import StatisticSet
+
+#Namespace of the metrics the tool records about itself
+DEFAULT_NAMESPACE = 'health-check-tool'
+
+#Upper bounds in seconds of the buckets of the stage duration histograms
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+#AWS error codes counted as throttles
+THROTTLE_ERROR_CODES = ('Throttling', 'ThrottlingException',
+    'RequestLimitExceeded', 'TooManyRequestsException', 'SlowDown')
+
+"""
+Histogram of the durations of one stage, with fixed buckets
+"""
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    """
+    Upper bound of the bucket holding the given quantile, or the largest
+    duration for the last bucket
+    """
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return self.max
+
+"""
+Timings of the stages of the health checks and counters of the calls they
+make. Stage durations are kept in histograms for the summary printed by
+report, and in one statistic set per stage since the last publish, which
+publish records as one metric per stage along with the counters.
+"""
+class Instrumentation(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.pending = {}
+        self.counters = {}
+        self.published_counters = {}
+
+    """
+    Time the enclosed block as one run of the named stage
+    """
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.histograms.setdefault(name, Histogram()).observe(seconds)
+            statistic_set = self.pending.get(name)
+            if statistic_set is None:
+                statistic_set = self.pending[name] = StatisticSet()
+            statistic_set.add(seconds)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    """
+    Record the stage durations and the counter increments since the last
+    publish with the publisher, under the Tool dimension
+    """
+    def publish(self, publisher, tool, namespace=DEFAULT_NAMESPACE):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            increments = dict((name, value - self.published_counters.get(name, 0))
+                for name, value in self.counters.items())
+            self.published_counters = dict(self.counters)
+
+        for name in sorted(pending):
+            publisher.put_statistics(namespace, 'stage_duration_seconds', 'Tool', tool,
+                pending[name], [{'Name': 'Stage', 'Value': name}], 'Seconds')
+
+        for name in sorted(increments):
+            publisher.put_metric(namespace, name, 'Tool', tool, increments[name])
+
+    """
+    Print one line per stage with its run count and duration statistics,
+    and one line with the counters
+    """
+    def report(self):
+        with self.lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+
+        for name in sorted(histograms):
+            histogram = histograms[name]
+            print("Stage {}: {} runs, mean {:.3f}s, p50 <= {}s, p95 <= {}s, max {:.3f}s".format(
+                name, histogram.count, histogram.total / histogram.count,
+                histogram.quantile(0.5), histogram.quantile(0.95), histogram.max))
+        if counters:
+            print("Counters: " + ", ".join('{}={}'.format(name, counters[name])
+                for name in sorted(counters)))
+
+#Instrumentation shared by every module of the process
+INSTRUMENTATION = Instrumentation()
+
+def stage(name):
+    return INSTRUMENTATION.stage(name)
+
+def count(name, amount=1):
+    INSTRUMENTATION.count(name, amount)
+
+"""
+Count the calls, retries, throttles and bytes of a boto3 client. Each
+HTTP attempt is counted in aws_attempts, each operation in aws_api_calls,
+so aws_attempts - aws_api_calls is the number of retries.
+"""
+def instrument_client(aws_client):
+    events = aws_client.meta.events
+
+    def before_send(request, **kwargs):
+        count('aws_attempts')
+        body = request.body
+        if body is not None and hasattr(body, '__len__'):
+            count('aws_bytes_sent', len(body))
+
+    def after_call(http_response, **kwargs):
+        count('aws_api_calls')
+        count('aws_bytes_received', len(http_response.content or b''))
+
+    def needs_retry(response=None, **kwargs):
+        if response is not None:
+            code = response[1].get('Error', {}).get('Code')
+            if code in THROTTLE_ERROR_CODES:
+                count('aws_throttles')
+
+    events.register('before-send', before_send)
+    events.register('after-call', after_call)
+    #Registered first as the retry handler stops the event when it retries
+    events.register_first('needs-retry', needs_retry)
+    return aws_client
+
+def self_metrics_enabled():
+    return os.environ.get('SELF_METRICS', '').lower() == 'true'
+
+"""
+Run a script's main function with instrumentation. When the SELF_METRICS
+environment variable is true, the stage timings and counters are printed
+and recorded as metrics of the tool once main returns. When PROFILE_OUTPUT
+is set, main runs under cProfile and the profile is written to that path,
+for inspection with pstats or snakeviz.
+"""
+def run_instrumented(main, tool):
+    profiler = None
+    if 'PROFILE_OUTPUT' in os.environ:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        with stage('total'):
+            main()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.environ['PROFILE_OUTPUT'])
+
+        if self_metrics_enabled():
+            INSTRUMENTATION.report()
+            #Imported here as the publisher module is itself instrumented
+            from metric_publisher import create_publisher
+            publisher = create_publisher()
+            INSTRUMENTATION.publish(publisher, tool)
+            publisher.close()
@@ -1,23 +1,36 @@
 import boto3
+import calendar
 import datetime
 import sys
 import os
+from report_renderer import ReportWindow, archive_report, create_summary_message
+from resilience import boto_config
+from resource_catalog import load_catalog
+from self_metrics import instrument_client, run_instrumented, stage
+from uptime_cache import UptimeCache
+from uptime_engine import align_stats, compute_uptime
+
+#Maximum number of metric queries accepted by one GetMetricData request
+MAX_METRIC_QUERIES = 500
 
 """
 Calculate the start time to be one month before the end time.
-Assumes the end time day will be valid for the previous month.
-For instance, end time may be the first of the month, but
-not the end of the month (e.g., not all months have 31 days).
+When the end time day does not exist in the previous month (e.g., the
+31st), the last day of the previous month is used.
 """
 def calc_start_time(end_time):
     if end_time.month == 1:
-        return end_time.replace(month=12, year=(end_time.year-1))
+        year, month = end_time.year - 1, 12
     else:
-        return end_time.replace(month=(end_time.month-1))
+        year, month = end_time.year, end_time.month - 1
+
+    day = min(end_time.day, calendar.monthrange(year, month)[1])
+    return end_time.replace(year=year, month=month, day=day)
 
 """
-Wrapper to call Cloudwatch get metric statistics function. The only
-statistic retrieved is the sum of the metrics.
+Wrapper to call Cloudwatch get metric statistics function. By default the
+only statistic retrieved is the sum of the metrics. Extra dimensions, given
+as a list of {'Name': ..., 'Value': ...}, are added to the query.
 
 The function returns a dictionary with a list 'Datapoints'. Each datapoint
 aggregates the statistics for one period. For instance, if the period is 
@@ -25,7 +38,8 @@ aggregates the statistics for one period. For instance, if the period is
 a single data point.
 """
 def get_metric_stats_wrapper(cloudwatch, namespace, metric_name, 
-    dimension_name, dimension_value, period, start_time, end_time):
+    dimension_name, dimension_value, period, start_time, end_time,
+    extra_dimensions=None, statistics=('Sum',)):
     
     stats = cloudwatch.get_metric_statistics(
         Namespace=namespace,
@@ -35,36 +49,68 @@ def get_metric_stats_wrapper(cloudwatch, namespace, metric_name,
                 'Name': dimension_name,
                 'Value': dimension_value
             },
-        ],
+        ] + list(extra_dimensions or []),
         StartTime=start_time,
         EndTime=end_time,
         Period=period,
-        Statistics=[
-            'Sum',
-        ],
+        Statistics=list(statistics),
     )
     
     return stats
 
 """
-Given a start time, an end time, a list of Cloudwatch metric statistics,
-and the frequency of checks in seconds, calculate the uptime. 
-This function assumes that the health metric of a resource is recorded with 
-value 1 for 'up', and value 0 for 'down'. The uptime is calculated by 
-summing the total number of checks reporting 'up' and dividing by the total 
-number of checks.
+Get the hourly (or other period) statistics of the health metrics of many
+resources with GetMetricData. Each statistic of each resource is one metric
+query; queries are sent up to MAX_METRIC_QUERIES at a time and each request
+is paginated, so the number of API calls grows with the number of resources
+divided by 500 rather than with the number of resources.
+
+Returns one dictionary per resource, in the order of the resources, with
+the same 'Datapoints' list of {'Timestamp': ..., 'Sum': ...} that
+get_metric_stats_wrapper returns, as read by uptime_engine.align_stats.
+Each datapoint has a key for every statistic requested.
 """
-def calc_uptime(stats, start_time, end_time, frequency):
-    total_up = 0.0
-    total_possible = (end_time-start_time).total_seconds()/frequency   #1 check / x seconds
-    
-    for point in stats['Datapoints']:
-        total_up += point['Sum']
-        
-    return 100 * total_up / total_possible
-    
-def send_uptime_report(message, topic):
-    sns = boto3.client('sns')
+def get_metric_data_wrapper(cloudwatch, resources, period, start_time, end_time,
+    statistics=('Sum',)):
+    points = [{} for resource in resources]
+    paginator = cloudwatch.get_paginator('get_metric_data')
+    resources_per_request = MAX_METRIC_QUERIES // len(statistics)
+
+    for chunk_start in range(0, len(resources), resources_per_request):
+        queries = []
+        for index in range(chunk_start, min(chunk_start + resources_per_request, len(resources))):
+            resource = resources[index]
+            for statistic in statistics:
+                queries.append({
+                    'Id': '{}_{}'.format(statistic.lower(), index),
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': resource.namespace,
+                            'MetricName': resource.metric_name,
+                            'Dimensions': resource.dimensions()
+                        },
+                        'Period': period,
+                        'Stat': statistic
+                    },
+                    'ReturnData': True
+                })
+
+        for page in paginator.paginate(MetricDataQueries=queries,
+            StartTime=start_time, EndTime=end_time,
+            ScanBy='TimestampAscending'):
+
+            for result in page['MetricDataResults']:
+                query_statistic, index = result['Id'].rsplit('_', 1)
+                statistic = [s for s in statistics if s.lower() == query_statistic][0]
+                resource_points = points[int(index)]
+                for timestamp, value in zip(result['Timestamps'], result['Values']):
+                    resource_points.setdefault(timestamp, {'Timestamp': timestamp})[statistic] = value
+
+    return [{'Datapoints': [resource_points[t] for t in sorted(resource_points)]}
+        for resource_points in points]
+
+def send_uptime_report(message, topic, session=None):
+    sns = instrument_client((session or boto3).client('sns', config=boto_config('sns')))
 
     response = sns.publish(
         TopicArn=topic,
@@ -72,6 +118,106 @@ def send_uptime_report(message, topic):
         Message=message
     )
 
+"""
+Send a report to the topic. When the REPORT_BUCKET environment variable is
+set, the full report is rendered as JSON, CSV and HTML to that bucket
+(under REPORT_PREFIX) and only a short summary with the links is sent, which
+keeps large catalogs under the SNS message size limit. Otherwise the text
+message is sent as is. The topic and bucket are written to with the boto3
+session given, if any; prefix overrides REPORT_PREFIX.
+"""
+def send_report(window_uptimes, message, topic, session=None, prefix=None):
+    if 'REPORT_BUCKET' not in os.environ:
+        send_uptime_report(message, topic, session)
+        return
+
+    s3 = instrument_client((session or boto3).client('s3', config=boto_config('s3')))
+    links = archive_report(s3, os.environ['REPORT_BUCKET'],
+        prefix or os.environ.get('REPORT_PREFIX', 'uptime-reports/'), window_uptimes,
+        datetime.datetime.utcnow())
+    send_uptime_report(create_summary_message(window_uptimes, links), topic, session)
+
+"""
+Fetch the Sum and SampleCount of each period of the health metrics of the
+resources, from Cloudwatch or, when a cache is given, from the cache after
+topping it up with the hours it is missing. Returns the tuple
+(all_stats, period), period being that of the datapoints returned: the
+cache always holds hourly datapoints.
+"""
+def fetch_uptime_stats(cloudwatch, resources, period, start_time, end_time, cache=None):
+    if cache is None:
+        return get_metric_data_wrapper(cloudwatch, resources, period,
+            start_time, end_time, ('Sum', 'SampleCount')), period
+
+    cache.update(lambda resources, period, start_time, end_time: get_metric_data_wrapper(
+        cloudwatch, resources, period, start_time, end_time, ('Sum', 'SampleCount')),
+        resources, start_time, end_time)
+    return [cache.get_stats(resource, start_time, end_time)
+        for resource in resources], 3600
+
+"""
+Calculate the uptime of every resource of the catalog from batched
+GetMetricData queries of the Sum and SampleCount of each period. The
+uptime columns of all resources are computed at once by
+uptime_engine.compute_uptime, so that periods without health checks are
+reported as unknown time instead of downtime.
+
+Returns a list of (resource, result) tuples in catalog order, result being
+a dictionary with the 'uptime', 'coverage', 'unknown', 'downtime' and
+'uptime_lower_bound' percentages of the resource.
+
+When a cache is given, it is first topped up with the hours it is missing
+and the uptimes are calculated from the cached hourly statistics.
+"""
+def collect_uptimes(cloudwatch, resources, period, start_time, end_time, frequency,
+    cache=None):
+    all_stats, period = fetch_uptime_stats(cloudwatch, resources, period,
+        start_time, end_time, cache)
+    sums, counts, lengths = align_stats(all_stats, start_time, end_time, period)
+    return uptime_rows(resources, compute_uptime(sums, counts, lengths, frequency))
+
+"""
+Split the uptime columns of compute_uptime into one (resource, result)
+tuple per resource
+"""
+def uptime_rows(resources, columns):
+    return [(resource, dict((name, float(values[row])) for name, values in columns.items()))
+        for row, resource in enumerate(resources)]
+
+"""
+Format one report line per resource
+"""
+def format_uptime_lines(uptimes):
+    return "".join("\t{}: {} (observed {:.2f}%, unknown {:.2f}%)\n".format(
+        resource.label, result['uptime'], result['coverage'], result['unknown'])
+        for resource, result in uptimes)
+
+"""
+Build the text of the uptime report, with one line per resource
+"""
+def create_report_message(start_time, end_time, uptimes):
+    #Format start and end times for message
+    start_time_str=start_time.strftime("%Y-%m-%d %H:%M:%S")
+    end_time_str=end_time.strftime("%Y-%m-%d %H:%M:%S")
+    message=("The uptime report is calculated as follows:\n\nSystem resource "
+        "statuses are obtained every minute. For Kubernetes, statuses are obtained "
+        "for each deployment and stateful set in the cluster. If a deployment or "
+        "stateful set has at least one available pod, a metric is recorded in "
+        "Cloudwatch with value 1, otherwise with a value of 0. Metrics are "
+        "similarly recorded in Cloudwatch for the statuses of NGINX and the REST "
+        "query endpoint. The NGINX metric represents successful redirection from "
+        "webapp.cvmvp.com to the CAS server; the REST query endpoint checks for "
+        "successful query responses.\n\nOnce a month, the uptime for each resource "
+        "is calculated as a percentage of the number of successful health checks to "
+        "the number of health checks recorded. Time during which no health check "
+        "was recorded is not counted as downtime; the share of the period that "
+        "was observed is shown next to each uptime.\n\n*****UPTIME FOR {} --- {}*****\n\n"
+        "\n").format(start_time_str, end_time_str)
+    
+    message += format_uptime_lines(uptimes)
+    
+    return message + "\n"
+
 def main():
     try:
         topic = os.environ['TOPIC_ARN']
@@ -79,7 +225,9 @@ def main():
     except:
         raise Exception('Missing environment variable: TOPIC_ARN or HEALTH_CHECK_FREQUENCY')
 
-    cloudwatch = boto3.client('cloudwatch')
+    cloudwatch = instrument_client(boto3.client('cloudwatch', config=boto_config('cloudwatch')))
+    with stage('load_catalog'):
+        resources = load_catalog()
 
     #Get the start time and end times for the metric collection time range
     end_time=datetime.datetime.utcnow()
@@ -94,119 +242,20 @@ def main():
     #Start time between greater than 63 days ago - use a multiple of 3600 seconds
     period=3600
     
-    #Start credentials db uptime
-    stats = get_metric_stats_wrapper(cloudwatch=cloudwatch, 
-        namespace='k8s-metrics', 
-        metric_name='credentials-db_statefulset_health_check', 
-        dimension_name='HealthCheck', 
-        dimension_value='Credentials-dbStatefulSetHealthCheck', 
-        period=period, 
-        start_time=start_time, 
-        end_time=end_time)
-        
-    cred_db_uptime = calc_uptime(stats, start_time, end_time, frequency)
-    #End credentials db uptime
-
-    #Start tim db uptime
-    stats = get_metric_stats_wrapper(cloudwatch=cloudwatch, 
-        namespace='k8s-metrics', 
-        metric_name='tim-db_statefulset_health_check', 
-        dimension_name='HealthCheck', 
-        dimension_value='Tim-dbStatefulSetHealthCheck', 
-        period=period, 
-        start_time=start_time, 
-        end_time=end_time)
-        
-    tim_db_uptime = calc_uptime(stats, start_time, end_time, frequency)
-    #End tim db uptime
-
-    #Start message validator uptime
-    stats = get_metric_stats_wrapper(cloudwatch=cloudwatch, 
-        namespace='k8s-metrics', 
-        metric_name='message-validator_deployment_health_check', 
-        dimension_name='HealthCheck', 
-        dimension_value='Message-validatorDeploymentHealthCheck', 
-        period=period, 
-        start_time=start_time, 
-        end_time=end_time)
-        
-    message_validator_uptime = calc_uptime(stats, start_time, end_time, frequency)
-    #End message validator uptime
-
-    #Start whtools uptime
-    stats = get_metric_stats_wrapper(cloudwatch=cloudwatch, 
-        namespace='k8s-metrics', 
-        metric_name='whtools_deployment_health_check', 
-        dimension_name='HealthCheck', 
-        dimension_value='WhtoolsDeploymentHealthCheck', 
-        period=period, 
-        start_time=start_time, 
-        end_time=end_time)
-        
-    whtools_uptime = calc_uptime(stats, start_time, end_time, frequency)
-    #End whtools uptime
-
-    #Start cas uptime
-    stats = get_metric_stats_wrapper(cloudwatch=cloudwatch, 
-        namespace='k8s-metrics', 
-        metric_name='cas_deployment_health_check', 
-        dimension_name='HealthCheck', 
-        dimension_value='CasDeploymentHealthCheck', 
-        period=period, 
-        start_time=start_time, 
-        end_time=end_time)
-        
-    cas_uptime = calc_uptime(stats, start_time, end_time, frequency)
-    #End cas uptime
-
-    #Start Nginx uptime
-    stats = get_metric_stats_wrapper(cloudwatch=cloudwatch, 
-        namespace='nginx', 
-        metric_name='nginx_redirect_health_check', 
-        dimension_name='HealthCheck', 
-        dimension_value='NginxRedirect', 
-        period=period, 
-        start_time=start_time, 
-        end_time=end_time)
-        
-    nginx_uptime = calc_uptime(stats, start_time, end_time, frequency)
-    #End Nginx uptime
-
-    #Start REST query uptime
-    stats = get_metric_stats_wrapper(cloudwatch=cloudwatch, 
-        namespace='query-endpoint', 
-        metric_name='query_endpoint_check', 
-        dimension_name='HealthCheck', 
-        dimension_value='QueryEndpoint', 
-        period=period, 
-        start_time=start_time, 
-        end_time=end_time)
-        
-    query_uptime = calc_uptime(stats, start_time, end_time, frequency)
-    #End REST query uptime
+    #Optional local store of the hourly sums, topped up on every report
+    cache = None
+    if 'UPTIME_CACHE' in os.environ:
+        cache = UptimeCache(os.environ['UPTIME_CACHE'])
     
-    #Format start and end times for message
-    start_time_str=start_time.strftime("%Y-%m-%d %H:%M:%S")
-    end_time_str=end_time.strftime("%Y-%m-%d %H:%M:%S")
-    message=("The uptime report is calculated as follows:\n\nSystem resource "
-        "statuses are obtained every minute. For Kubernetes, statuses are obtained "
-        "for each deployment and stateful set in the cluster. If a deployment or "
-        "stateful set has at least one available pod, a metric is recorded in "
-        "Cloudwatch with value 1, otherwise with a value of 0. Metrics are "
-        "similarly recorded in Cloudwatch for the statuses of NGINX and the REST "
-        "query endpoint. The NGINX metric represents successful redirection from "
-        "webapp.cvmvp.com to the CAS server; the REST query endpoint checks for "
-        "successful query responses.\n\nOnce a month, the uptime for each resource "
-        "is calculated as a percentage of the number of successful health checks to "
-        "the total number of health checks.\n\n*****UPTIME FOR {} --- {}*****\n\n"
-        "\n\tCREDENTIALS-DB STATEFULSET: {}\n\tTIM-DB STATEFULSET: {}\n\tMESSAGE-VALIDATOR "
-        "DEPLOYMENT: {}\n\tWHTOOLS DEPLOYMENT: {}\n\tCAS DEPLOYMENT: {}\n\tNGINX REDIRECT "
-        "UPTIME: {}\n\tREST QUERY ENDPOINT: {}\n\n").format(start_time_str, end_time_str, 
-        cred_db_uptime, tim_db_uptime, message_validator_uptime, whtools_uptime, 
-        cas_uptime, nginx_uptime, query_uptime)
+    with stage('collect_uptimes'):
+        uptimes = collect_uptimes(cloudwatch, resources, period, start_time, end_time,
+            frequency, cache)
+    message = create_report_message(start_time, end_time, uptimes)
     
     #Send the uptime report
-    send_uptime_report(message, topic)
+    with stage('send_report'):
+        send_report([(ReportWindow('last month', start_time, end_time), uptimes)],
+            message, topic)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    run_instrumented(main, 'uptime')
\ No newline at end of file
@@ -0,0 +1,152 @@
+import calendar
+import datetime
+import sqlite3
+
+#Period in seconds of the sums kept in the cache
+HOUR = 3600
+
+#Hours fetched again before the last synced hour on each update, so that
+#datapoints Cloudwatch received late are picked up
+OVERLAP_HOURS = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hourly (
+    resource TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    sample_count REAL NOT NULL,
+    PRIMARY KEY (resource, timestamp)
+);
+CREATE TABLE IF NOT EXISTS synced (
+    resource TEXT PRIMARY KEY,
+    synced_from INTEGER NOT NULL,
+    synced_until INTEGER NOT NULL
+);
+'''
+
+"""
+Convert a datetime to seconds since the epoch. Naive datetimes are taken
+to be UTC, as returned by datetime.datetime.utcnow().
+"""
+def to_epoch(time):
+    return calendar.timegm(time.utctimetuple())
+
+def from_epoch(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+"""
+Round seconds since the epoch down to a multiple of step
+"""
+def floor_to(seconds, step):
+    return seconds - seconds % step
+
+"""
+Key identifying the health metric of a resource in the cache
+"""
+def resource_key(resource):
+    dimensions = ','.join('{}={}'.format(d['Name'], d['Value']) for d in resource.dimensions())
+    return '{}|{}|{}'.format(resource.namespace, resource.metric_name, dimensions)
+
+"""
+Local SQLite store of the hourly sums and sample counts of resource health
+metrics.
+
+update tops the store up from Cloudwatch: for each resource only the hours
+after the last synced hour (and, for a report reaching further back, the
+hours before the first synced hour) are fetched, with resources that need
+the same range fetched together in one batched query. The synced hours of
+a resource are always kept contiguous. Reports are then answered from the
+store with get_stats, which keeps history past the retention of Cloudwatch
+for quarterly and annual reports.
+
+The store works in whole UTC hours: a range is widened to the hours that
+contain it. Only hourly rows are kept: the uptime engine aligns every
+series on the hourly period, and a year of one resource is under 9000
+rows read from an index, so daily rollups would save little and could not
+be used without a period aware engine.
+"""
+class UptimeCache(object):
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.api_fetches = 0
+
+    def close(self):
+        self.connection.close()
+
+    """
+    Make sure the store holds every hour between start_time and end_time for
+    each resource, fetching only the missing hours. fetch_stats is called as
+    fetch_stats(resources, period, start_time, end_time) and returns one
+    'Datapoints' dictionary per resource, like uptime.get_metric_data_wrapper.
+    """
+    def update(self, fetch_stats, resources, start_time, end_time):
+        start = floor_to(to_epoch(start_time), HOUR)
+        end = floor_to(to_epoch(end_time) + HOUR - 1, HOUR)
+
+        #Group the resources by the range they are missing so that each
+        #group is fetched with one batched query
+        ranges = {}
+        for resource in resources:
+            for fetch_range in self._missing_ranges(resource_key(resource), start, end):
+                ranges.setdefault(fetch_range, []).append(resource)
+
+        for (fetch_start, fetch_end), group in sorted(ranges.items()):
+            self._fetch(fetch_stats, group, fetch_start, fetch_end)
+
+    """
+    Return the ranges of hours that must be fetched for a resource
+    """
+    def _missing_ranges(self, key, start, end):
+        row = self.connection.execute(
+            'SELECT synced_from, synced_until FROM synced WHERE resource = ?',
+            (key,)).fetchone()
+        if row is None:
+            return [(start, end)]
+
+        synced_from, synced_until = row
+        ranges = []
+        if start < synced_from:
+            ranges.append((start, synced_from))
+        if end > synced_until - OVERLAP_HOURS * HOUR:
+            ranges.append((synced_until - OVERLAP_HOURS * HOUR, end))
+        return ranges
+
+    """
+    Fetch the hourly sums and sample counts of a group of resources and store
+    them
+    """
+    def _fetch(self, fetch_stats, resources, start, end):
+        all_stats = fetch_stats(resources, HOUR, from_epoch(start), from_epoch(end))
+        self.api_fetches += 1
+
+        with self.connection:
+            for resource, stats in zip(resources, all_stats):
+                key = resource_key(resource)
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO hourly (resource, timestamp, sum, sample_count) '
+                    'VALUES (?, ?, ?, ?)',
+                    [(key, floor_to(to_epoch(point['Timestamp']), HOUR), point['Sum'],
+                        point.get('SampleCount', 0.0))
+                        for point in stats['Datapoints']])
+                self.connection.execute(
+                    'INSERT INTO synced (resource, synced_from, synced_until) VALUES (?, ?, ?) '
+                    'ON CONFLICT(resource) DO UPDATE SET '
+                    'synced_from = MIN(synced_from, excluded.synced_from), '
+                    'synced_until = MAX(synced_until, excluded.synced_until)',
+                    (key, start, end))
+
+    """
+    Return the hourly sums and sample counts of a resource between
+    start_time and end_time in the 'Datapoints' format of
+    uptime.get_metric_data_wrapper
+    """
+    def get_stats(self, resource, start_time, end_time):
+        start = floor_to(to_epoch(start_time), HOUR)
+        end = floor_to(to_epoch(end_time) + HOUR - 1, HOUR)
+        rows = self.connection.execute(
+            'SELECT timestamp, sum, sample_count FROM hourly WHERE resource = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp',
+            (resource_key(resource), start, end)).fetchall()
+
+        return {'Datapoints': [{'Timestamp': from_epoch(timestamp), 'Sum': value,
+            'SampleCount': sample_count} for timestamp, value, sample_count in rows]}
@@ -0,0 +1,75 @@
+import numpy as np
+from uptime_cache import to_epoch, floor_to
+
+"""
+Lay the datapoints of many resources out on a common grid of periods.
+
+all_stats holds one 'Datapoints' dictionary per resource, each datapoint
+having 'Timestamp', 'Sum' and 'SampleCount'. Returns the tuple
+(sums, counts, lengths): two arrays of shape (resources, periods) with the
+Sum and SampleCount of each period (0 where there is no datapoint), and the
+length in seconds of each period. Periods are aligned to multiples of the
+period since the epoch, as Cloudwatch aligns them, so the first and last
+periods are shorter when the range does not start or end on a boundary.
+"""
+def align_stats(all_stats, start_time, end_time, period):
+    start = to_epoch(start_time)
+    end = to_epoch(end_time)
+    origin = floor_to(start, period)
+    period_starts = np.arange(origin, end, period)
+    lengths = (np.minimum(period_starts + period, end)
+        - np.maximum(period_starts, start)).astype(float)
+
+    sums = np.zeros((len(all_stats), len(period_starts)))
+    counts = np.zeros((len(all_stats), len(period_starts)))
+    for row, stats in enumerate(all_stats):
+        points = stats['Datapoints']
+        if not points:
+            continue
+
+        columns = (np.array([to_epoch(p['Timestamp']) for p in points]) - origin) // period
+        inside = (columns >= 0) & (columns < len(period_starts))
+        columns = columns[inside].astype(int)
+        np.add.at(sums[row], columns, np.array([p['Sum'] for p in points])[inside])
+        np.add.at(counts[row], columns, np.array([p['SampleCount'] for p in points])[inside])
+
+    return sums, counts, lengths
+
+"""
+Compute uptime columns for all resources at once from aligned Sum and
+SampleCount arrays, with one health check expected every frequency seconds.
+
+Each period is expected to hold lengths / frequency samples. Periods with
+fewer samples than expected (the checker itself was not running) are not
+counted as downtime but as unknown time. Periods with more samples than
+expected (checks that ran twice) are scaled back to the expected number,
+keeping their ratio of up to down samples, so they do not add extra uptime.
+
+Returns a dictionary of arrays with one value per resource, all in percent:
+* uptime - up time as a share of the time the resource was observed; NaN
+  for a resource that was never observed
+* coverage - observed time as a share of the whole range
+* unknown - time without observations as a share of the whole range
+* downtime - observed down time as a share of the whole range
+* uptime_lower_bound - up time as a share of the whole range, that is the
+  uptime if all unknown time had been down
+"""
+def compute_uptime(sums, counts, lengths, frequency):
+    expected = lengths / frequency
+    observed = np.minimum(counts, expected)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        up_ratio = np.where(counts > 0, sums / counts, 0.0)
+        up = up_ratio * observed
+
+        total_expected = expected.sum()
+        total_observed = observed.sum(axis=1)
+        total_up = up.sum(axis=1)
+
+        return {
+            'uptime': np.where(total_observed > 0, 100 * total_up / total_observed, np.nan),
+            'coverage': 100 * total_observed / total_expected,
+            'unknown': 100 * (total_expected - total_observed) / total_expected,
+            'downtime': 100 * (total_observed - total_up) / total_expected,
+            'uptime_lower_bound': 100 * total_up / total_expected
+        }
@@ -0,0 +1,218 @@
+import boto3
+import datetime
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from report_renderer import ReportWindow, clean_value, format_percent
+from resilience import boto_config, limit_concurrent_calls
+from resource_catalog import load_catalog
+from self_metrics import instrument_client, run_instrumented, stage
+from uptime import (calc_start_time, collect_uptimes, create_report_message,
+    send_report, send_uptime_report)
+
+#Period in seconds of the datapoints fetched for the monthly reports
+PERIOD = 3600
+
+#Number of (profile, region) groups fetched at the same time
+DEFAULT_MAX_WORKERS = 4
+
+#Concurrent Cloudwatch calls allowed per AWS account across all groups
+DEFAULT_ACCOUNT_MAX_CALLS = 4
+
+"""
+One environment to report on: the resources of a catalog, read with the
+credentials of an AWS profile in a region, reported to an SNS topic.
+Targets without an account are assumed to be in the account of their
+profile.
+"""
+class UptimeTarget(object):
+    def __init__(self, name, catalog, topic, profile=None, region=None, account=None):
+        self.name = name
+        self.catalog = catalog
+        self.topic = topic
+        self.profile = profile
+        self.region = region
+        self.account = account or profile
+
+    """
+    Targets with the same session key read the same Cloudwatch metrics
+    """
+    def session_key(self):
+        return (self.profile, self.region)
+
+"""
+Load the targets file, a JSON object with a 'targets' list of
+{'name', 'catalog', 'topic', 'profile', 'region', 'account'} entries and
+an optional 'summary_topic'. Returns the tuple (targets, summary_topic).
+"""
+def load_targets(path):
+    with open(path) as f:
+        config = json.load(f)
+    return [UptimeTarget(**entry) for entry in config['targets']], config.get('summary_topic')
+
+"""
+Identity of the health metric of a resource, equal for the same metric
+listed in several catalogs
+"""
+def metric_key(resource):
+    return (resource.namespace, resource.metric_name,
+        tuple((d['Name'], d['Value']) for d in resource.dimensions()))
+
+"""
+The resources of several catalogs with each health metric kept once, in
+the order they first appear
+"""
+def unique_resources(catalogs):
+    resources = {}
+    for catalog in catalogs:
+        for resource in catalog:
+            resources.setdefault(metric_key(resource), resource)
+    return list(resources.values())
+
+"""
+Calculate the uptimes of all targets sharing a session. The health metrics
+of their catalogs are fetched once, so a metric listed in several catalogs
+is only queried once, and each target then takes its own rows. Returns a
+list of (target, uptimes) tuples, uptimes being the (resource, result)
+tuples of uptime.collect_uptimes.
+"""
+def collect_group_uptimes(cloudwatch, targets, catalogs, start_time, end_time, frequency):
+    resources = unique_resources(catalogs[target.name] for target in targets)
+    results = dict((metric_key(resource), result) for resource, result in
+        collect_uptimes(cloudwatch, resources, PERIOD, start_time, end_time, frequency))
+    return [(target, [(resource, results[metric_key(resource)])
+        for resource in catalogs[target.name]]) for target in targets]
+
+"""
+Runs the monthly uptime report of several environments at the same time.
+Targets are grouped by (profile, region); each group gets one Cloudwatch
+client and one fetch, and groups run on a thread pool. The Cloudwatch
+clients of one account share a semaphore, so that the calls in flight per
+account stay under account_max_calls whatever the number of groups.
+"""
+class UptimeFanout(object):
+    def __init__(self, targets, max_workers=DEFAULT_MAX_WORKERS,
+        account_max_calls=DEFAULT_ACCOUNT_MAX_CALLS):
+
+        self.targets = targets
+        self.max_workers = max_workers
+        self.account_max_calls = account_max_calls
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.account_limits = {}
+
+    def session(self, target):
+        key = target.session_key()
+        with self.lock:
+            if key not in self.sessions:
+                self.sessions[key] = boto3.session.Session(profile_name=target.profile,
+                    region_name=target.region)
+            return self.sessions[key]
+
+    def cloudwatch(self, target):
+        with self.lock:
+            limit = self.account_limits.get(target.account)
+            if limit is None:
+                limit = self.account_limits[target.account] = threading.BoundedSemaphore(
+                    self.account_max_calls)
+        cloudwatch = self.session(target).client('cloudwatch', config=boto_config('cloudwatch'))
+        return limit_concurrent_calls(instrument_client(cloudwatch), limit)
+
+    """
+    Calculate the uptimes of every target. Returns a list of (target,
+    uptimes, error) tuples in the order of the targets; a group that fails
+    has error set and uptimes None, without stopping the other groups.
+    """
+    def collect(self, start_time, end_time, frequency):
+        catalogs = dict((target.name, load_catalog(target.catalog)) for target in self.targets)
+        groups = {}
+        for target in self.targets:
+            groups.setdefault(target.session_key(), []).append(target)
+
+        def collect_group(targets):
+            try:
+                return collect_group_uptimes(self.cloudwatch(targets[0]), targets, catalogs,
+                    start_time, end_time, frequency), None
+            except Exception as e:
+                print("Uptime collection failed for {}: {}".format(
+                    ', '.join(target.name for target in targets), e))
+                return [(target, None) for target in targets], e
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            group_results = list(executor.map(collect_group, groups.values()))
+
+        results = {}
+        for target_uptimes, error in group_results:
+            for target, uptimes in target_uptimes:
+                results[target.name] = (target, uptimes, error)
+        return [results[target.name] for target in self.targets]
+
+    """
+    Send the report of each target that was collected to its topic, with
+    the session of the target
+    """
+    def send_reports(self, results, start_time, end_time):
+        window = ReportWindow('last month', start_time, end_time)
+        prefix = os.environ.get('REPORT_PREFIX', 'uptime-reports/')
+        for target, uptimes, error in results:
+            if error is not None:
+                continue
+            try:
+                send_report([(window, uptimes)], create_report_message(start_time, end_time, uptimes),
+                    target.topic, self.session(target), prefix + target.name + '/')
+            except Exception as e:
+                print("Failed to send the uptime report of {}: {}".format(target.name, e))
+
+"""
+Build the combined summary: per environment, the number of resources, the
+mean uptime of the observed resources and the lowest uptime, or the error
+that stopped its collection
+"""
+def create_fanout_summary(results, start_time, end_time):
+    message = "Uptime summary of {} environments, {} --- {}\n\n".format(len(results),
+        start_time.strftime("%Y-%m-%d %H:%M:%S"), end_time.strftime("%Y-%m-%d %H:%M:%S"))
+    for target, uptimes, error in results:
+        if error is not None:
+            message += "\t{}: failed ({})\n".format(target.name, error)
+            continue
+        observed = [(resource, result) for resource, result in uptimes
+            if clean_value(result['uptime']) is not None]
+        if not observed:
+            message += "\t{}: {} resources, none observed\n".format(target.name, len(uptimes))
+            continue
+        mean = sum(result['uptime'] for _, result in observed) / len(observed)
+        lowest_resource, lowest = min(observed, key=lambda item: item[1]['uptime'])
+        message += "\t{}: {} resources, mean {}, lowest {} {}\n".format(target.name,
+            len(uptimes), format_percent(mean), lowest_resource.label,
+            format_percent(lowest['uptime']))
+    return message
+
+def main():
+    try:
+        targets_path = os.environ['UPTIME_TARGETS']
+        frequency = float(os.environ['HEALTH_CHECK_FREQUENCY'])
+    except:
+        raise Exception('Missing environment variable: UPTIME_TARGETS or HEALTH_CHECK_FREQUENCY')
+
+    targets, summary_topic = load_targets(targets_path)
+    summary_topic = os.environ.get('UPTIME_SUMMARY_TOPIC', summary_topic)
+    fanout = UptimeFanout(targets,
+        int(os.environ.get('UPTIME_FANOUT_WORKERS', DEFAULT_MAX_WORKERS)),
+        int(os.environ.get('UPTIME_ACCOUNT_MAX_CALLS', DEFAULT_ACCOUNT_MAX_CALLS)))
+
+    end_time = datetime.datetime.utcnow()
+    start_time = calc_start_time(end_time)
+    with stage('collect_uptimes'):
+        results = fanout.collect(start_time, end_time, frequency)
+    with stage('send_report'):
+        fanout.send_reports(results, start_time, end_time)
+
+    summary = create_fanout_summary(results, start_time, end_time)
+    if summary_topic:
+        send_uptime_report(summary, summary_topic)
+    else:
+        print(summary)
+
+if __name__ == '__main__':
+    run_instrumented(main, 'uptime_fanout')
@@ -0,0 +1,213 @@
+import boto3
+import datetime
+import os
+from resilience import boto_config
+from resource_catalog import load_catalog
+from self_metrics import instrument_client, run_instrumented, stage
+from uptime import calc_start_time, get_metric_stats_wrapper, send_uptime_report
+from uptime_cache import to_epoch
+
+#Resolution in seconds of the health check series analyzed for incidents
+INCIDENT_PERIOD = 60
+
+#Maximum number of datapoints returned by one GetMetricStatistics call
+MAX_DATAPOINTS = 1440
+
+#Down intervals separated by at most this many seconds of up time are
+#merged into one incident, so that a flapping resource counts once
+DEFAULT_MERGE_THRESHOLD = 300
+
+#Age in seconds after which Cloudwatch only keeps coarser datapoints, and the
+#smallest period that can be requested past that age
+RETENTION_PERIODS = [
+    (63 * 86400, 3600),
+    (15 * 86400, 300)
+]
+
+"""
+Return the period to request for datapoints starting at start_time. Minute
+datapoints are only kept for 15 days and 5 minute datapoints for 63 days,
+so older chunks are requested with the coarsest period still available.
+"""
+def chunk_period(start_time, now, period=INCIDENT_PERIOD):
+    age = to_epoch(now) - to_epoch(start_time)
+    for max_age, min_period in RETENTION_PERIODS:
+        if age > max_age:
+            return max(period, min_period)
+    return period
+
+"""
+Yield the datapoints of the health metric of a resource in time order, one
+chunk of at most MAX_DATAPOINTS at a time, each datapoint with its
+'Timestamp', 'Sum', 'SampleCount' and the 'Period' it covers. Only one
+chunk is held in memory at a time.
+"""
+def iter_datapoints(cloudwatch, resource, start_time, end_time, period=INCIDENT_PERIOD,
+    now=None):
+    now = now or datetime.datetime.utcnow()
+    chunk_start = start_time
+    while chunk_start < end_time:
+        chunk_period_seconds = chunk_period(chunk_start, now, period)
+        chunk_end = min(end_time, chunk_start
+            + datetime.timedelta(seconds=chunk_period_seconds * MAX_DATAPOINTS))
+
+        stats = get_metric_stats_wrapper(cloudwatch, resource.namespace,
+            resource.metric_name, resource.dimension_name, resource.dimension_value,
+            chunk_period_seconds, chunk_start, chunk_end, resource.extra_dimensions,
+            statistics=('Sum', 'SampleCount'))
+
+        for point in sorted(stats['Datapoints'], key=lambda p: p['Timestamp']):
+            point['Period'] = chunk_period_seconds
+            yield point
+
+        chunk_start = chunk_end
+
+"""
+Streaming extraction of the downtime incidents of one resource. Periods are
+fed in time order; a period is down when most of its health checks failed,
+which at minute resolution is when its single check failed. Periods with
+no datapoint are unknown: they neither end nor extend an incident.
+
+Consecutive down periods form a down interval. A down interval following
+the previous one after at most merge_threshold seconds of up time is merged
+into the same incident, so down periods with only unknown periods between
+them always form one incident. The duration of an incident is its down
+time plus the up time of the flaps merged into it. Only running totals are
+kept, so memory does not grow with the length of the series.
+"""
+class IncidentTracker(object):
+    def __init__(self, merge_threshold=DEFAULT_MERGE_THRESHOLD):
+        self.merge_threshold = merge_threshold
+        self.incidents = 0
+        self.downtime = 0
+        self.uptime = 0
+        self.pending_uptime = 0
+        self.longest_outage = 0
+        self.longest_outage_start = None
+        self.current_start = None
+        self.current_duration = 0
+
+    """
+    Add the period starting at timestamp, in seconds since the epoch
+    """
+    def add(self, timestamp, period, down):
+        #Up time after a down interval only counts once it is known not to
+        #be a flap inside a merged incident
+        if not down:
+            self.pending_uptime += period
+            return
+
+        if self.current_start is not None and self.pending_uptime <= self.merge_threshold:
+            self.current_duration += self.pending_uptime + period
+            self.pending_uptime = 0
+            return
+
+        self._close()
+        self.current_start = timestamp
+        self.current_duration = period
+
+    def add_datapoint(self, point):
+        self.add(to_epoch(point['Timestamp']), point['Period'],
+            point['Sum'] * 2 < point['SampleCount'])
+
+    def _close(self):
+        self.uptime += self.pending_uptime
+        self.pending_uptime = 0
+        if self.current_start is None:
+            return
+
+        duration = self.current_duration
+        self.incidents += 1
+        self.downtime += duration
+        if duration > self.longest_outage:
+            self.longest_outage = duration
+            self.longest_outage_start = self.current_start
+        self.current_start = None
+        self.current_duration = 0
+
+    """
+    Close the open incident and return the statistics of the series, all
+    durations in seconds:
+    * incidents - number of incidents
+    * longest_outage - duration of the longest incident
+    * longest_outage_start - start of the longest incident, as a datetime
+    * mttr - mean time to recovery, the mean duration of an incident
+    * mtbf - mean time between failures, the observed up time divided by
+      the number of incidents
+    mttr and mtbf are None when there was no incident.
+    """
+    def summary(self):
+        self._close()
+        has_incidents = self.incidents > 0
+        return {
+            'incidents': self.incidents,
+            'longest_outage': self.longest_outage,
+            'longest_outage_start': datetime.datetime.utcfromtimestamp(self.longest_outage_start)
+                if has_incidents else None,
+            'mttr': float(self.downtime) / self.incidents if has_incidents else None,
+            'mtbf': float(self.uptime) / self.incidents if has_incidents else None
+        }
+
+"""
+Extract the incident statistics of every resource between start_time and
+end_time. Resources are streamed one after another, one chunk of
+datapoints at a time. Returns a list of (resource, summary) tuples in
+catalog order, summary being the dictionary of IncidentTracker.summary.
+"""
+def analyze_incidents(cloudwatch, resources, start_time, end_time,
+    merge_threshold=DEFAULT_MERGE_THRESHOLD, period=INCIDENT_PERIOD):
+    summaries = []
+    for resource in resources:
+        tracker = IncidentTracker(merge_threshold)
+        for point in iter_datapoints(cloudwatch, resource, start_time, end_time, period):
+            tracker.add_datapoint(point)
+        summaries.append((resource, tracker.summary()))
+    return summaries
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+"""
+Build the text of the incident report, with one line per resource
+"""
+def create_incident_message(start_time, end_time, summaries, merge_threshold):
+    message = ("Downtime incidents are contiguous periods in which the health check "
+        "of a resource failed. Failures separated by at most {} of up time are "
+        "counted as one incident. MTTR is the mean duration of an incident and "
+        "MTBF the mean up time between incidents.\n\n*****INCIDENTS FOR {} --- {}*****\n\n\n").format(
+        format_duration(merge_threshold),
+        start_time.strftime("%Y-%m-%d %H:%M:%S"),
+        end_time.strftime("%Y-%m-%d %H:%M:%S"))
+
+    for resource, summary in summaries:
+        message += "\t{}: {} incidents, longest {}, MTTR {}, MTBF {}\n".format(
+            resource.label, summary['incidents'],
+            format_duration(summary['longest_outage'] or None),
+            format_duration(summary['mttr']), format_duration(summary['mtbf']))
+
+    return message + "\n"
+
+def main():
+    merge_threshold = float(os.environ.get('INCIDENT_MERGE_THRESHOLD', DEFAULT_MERGE_THRESHOLD))
+    cloudwatch = instrument_client(boto3.client('cloudwatch', config=boto_config('cloudwatch')))
+    with stage('load_catalog'):
+        resources = load_catalog()
+
+    end_time = datetime.datetime.utcnow()
+    start_time = calc_start_time(end_time)
+
+    with stage('analyze_incidents'):
+        summaries = analyze_incidents(cloudwatch, resources, start_time, end_time, merge_threshold)
+    message = create_incident_message(start_time, end_time, summaries, merge_threshold)
+
+    #Send the report when a topic is configured, else print it
+    if 'TOPIC_ARN' in os.environ:
+        with stage('send_report'):
+            send_uptime_report(message, os.environ['TOPIC_ARN'])
+    else:
+        print(message)
+
+if __name__ == '__main__':
+    run_instrumented(main, 'uptime_incidents')
@@ -0,0 +1,168 @@
+import boto3
+import datetime
+import os
+from concurrent.futures import ThreadPoolExecutor
+from resilience import boto_config
+from resource_catalog import load_catalog
+from report_renderer import ReportWindow
+from self_metrics import instrument_client, run_instrumented, stage
+from uptime import (calc_start_time, fetch_uptime_stats, format_uptime_lines,
+    send_report, uptime_rows)
+from uptime_cache import UptimeCache, floor_to, to_epoch
+from uptime_engine import align_stats, compute_uptime
+
+#Period in seconds of the datapoints shared by all windows. Window
+#boundaries are rounded down to whole hours.
+WINDOW_PERIOD = 3600
+
+#Windows computed when the UPTIME_WINDOWS environment variable is not set
+DEFAULT_WINDOWS = 'month:1,week:1,rolling:7,rolling:30,rolling:90'
+
+#Number of windows computed at the same time
+DEFAULT_MAX_WORKERS = 4
+
+def floor_to_hour(time):
+    return time.replace(minute=0, second=0, microsecond=0)
+
+"""
+The count last complete calendar months before end_time, oldest first
+"""
+def calendar_month_windows(end_time, count):
+    windows = []
+    month_end = end_time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    for _ in range(count):
+        month_start = calc_start_time(month_end)
+        windows.append(ReportWindow(month_start.strftime('%Y-%m'), month_start, month_end))
+        month_end = month_start
+    return windows[::-1]
+
+"""
+The count last complete ISO weeks (Monday to Monday) before end_time,
+oldest first
+"""
+def iso_week_windows(end_time, count):
+    windows = []
+    week_end = end_time.replace(hour=0, minute=0, second=0, microsecond=0) \
+        - datetime.timedelta(days=end_time.weekday())
+    for _ in range(count):
+        week_start = week_end - datetime.timedelta(days=7)
+        year, week, _ = week_start.isocalendar()
+        windows.append(ReportWindow('{}-W{:02d}'.format(year, week), week_start, week_end))
+        week_end = week_start
+    return windows[::-1]
+
+"""
+The days days up to end_time, rounded down to the hour
+"""
+def rolling_window(end_time, days):
+    end_time = floor_to_hour(end_time)
+    return ReportWindow('last {} days'.format(days),
+        end_time - datetime.timedelta(days=days), end_time)
+
+"""
+A fixed range given as start/end, each in YYYY-MM-DD or YYYY-MM-DDTHH form
+"""
+def custom_window(value):
+    times = []
+    for part in value.split('/'):
+        time_format = '%Y-%m-%dT%H' if 'T' in part else '%Y-%m-%d'
+        times.append(datetime.datetime.strptime(part, time_format))
+    start_time, end_time = times
+    return ReportWindow(value, start_time, end_time)
+
+"""
+Create the windows of a comma separated specification of kind:value items:
+* month:N - the last N calendar months
+* week:N - the last N ISO weeks
+* rolling:N - the last N days
+* custom:START/END - a fixed range, e.g. custom:2018-01-01/2018-04-01
+"""
+def parse_windows(spec, end_time):
+    windows = []
+    for item in spec.split(','):
+        kind, value = item.strip().split(':', 1)
+        if kind == 'month':
+            windows.extend(calendar_month_windows(end_time, int(value)))
+        elif kind == 'week':
+            windows.extend(iso_week_windows(end_time, int(value)))
+        elif kind == 'rolling':
+            windows.append(rolling_window(end_time, int(value)))
+        elif kind == 'custom':
+            windows.append(custom_window(value))
+        else:
+            raise ValueError('Unknown report window: {}'.format(item))
+    return windows
+
+"""
+Calculate the uptime of every resource for every window. The hourly
+statistics of the range covering all windows are fetched once (or read
+from the cache) and aligned once; each window is then a slice of the same
+arrays, and the windows are computed in parallel on the executor when one
+is given.
+
+Returns a list of (window, uptimes) tuples in the order of the windows,
+uptimes being the list of (resource, result) tuples of
+uptime.collect_uptimes.
+"""
+def collect_window_uptimes(cloudwatch, resources, windows, frequency, cache=None,
+    executor=None):
+    start_time = min(window.start_time for window in windows)
+    end_time = max(window.end_time for window in windows)
+    all_stats, period = fetch_uptime_stats(cloudwatch, resources, WINDOW_PERIOD,
+        start_time, end_time, cache)
+    sums, counts, lengths = align_stats(all_stats, start_time, end_time, period)
+    origin = floor_to(to_epoch(start_time), period)
+
+    def compute_window(window):
+        first = (to_epoch(window.start_time) - origin) // period
+        last = (to_epoch(window.end_time) - origin + period - 1) // period
+        columns = compute_uptime(sums[:, first:last], counts[:, first:last],
+            lengths[first:last], frequency)
+        return uptime_rows(resources, columns)
+
+    if executor is None:
+        results = [compute_window(window) for window in windows]
+    else:
+        results = list(executor.map(compute_window, windows))
+    return list(zip(windows, results))
+
+"""
+Build the text of the report, with one section per window
+"""
+def create_windows_message(window_uptimes):
+    message = ("Uptime per report window. The uptime of each resource is the "
+        "percentage of successful health checks among the health checks recorded "
+        "in the window; time without health checks is shown as unknown.\n\n")
+    for window, uptimes in window_uptimes:
+        message += "*****{}: {} --- {}*****\n\n".format(window.name,
+            window.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            window.end_time.strftime("%Y-%m-%d %H:%M:%S"))
+        message += format_uptime_lines(uptimes) + "\n"
+    return message
+
+def main():
+    try:
+        topic = os.environ['TOPIC_ARN']
+        frequency = float(os.environ['HEALTH_CHECK_FREQUENCY'])
+    except:
+        raise Exception('Missing environment variable: TOPIC_ARN or HEALTH_CHECK_FREQUENCY')
+
+    cloudwatch = instrument_client(boto3.client('cloudwatch', config=boto_config('cloudwatch')))
+    with stage('load_catalog'):
+        resources = load_catalog()
+    windows = parse_windows(os.environ.get('UPTIME_WINDOWS', DEFAULT_WINDOWS),
+        datetime.datetime.utcnow())
+
+    cache = None
+    if 'UPTIME_CACHE' in os.environ:
+        cache = UptimeCache(os.environ['UPTIME_CACHE'])
+
+    with stage('collect_uptimes'), ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS) as executor:
+        window_uptimes = collect_window_uptimes(cloudwatch, resources, windows,
+            frequency, cache, executor)
+
+    with stage('send_report'):
+        send_report(window_uptimes, create_windows_message(window_uptimes), topic)
+
+if __name__ == '__main__':
+    run_instrumented(main, 'uptime_windows')
@@ -0,0 +1,120 @@
+import csv
+import datetime
+import io
+import json
+import os
+import sys
+import unittest
+import boto3
+from moto import mock_aws
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from report_renderer import (PART_SIZE, ReportWindow, S3MultipartWriter, archive_report,
+    create_summary_message)
+from resource_catalog import Resource
+
+BUCKET = 'uptime-reports'
+
+GENERATED_TIME = datetime.datetime(2024, 3, 1, 6, 30, 0)
+
+def create_window_uptimes():
+    window = ReportWindow('last month', datetime.datetime(2024, 2, 1),
+        datetime.datetime(2024, 3, 1))
+    uptimes = []
+    for index, uptime in enumerate([99.5, 100.0, float('nan'), 97.25]):
+        resource = Resource('service{}'.format(index), 'SERVICE{}'.format(index),
+            'k8s-metrics', 'service{}_health'.format(index), 'Service{}Health'.format(index))
+        uptimes.append((resource, {'uptime': uptime, 'coverage': 100.0, 'unknown': 0.0,
+            'downtime': 100.0 - uptime, 'uptime_lower_bound': uptime}))
+    return [(window, uptimes)]
+
+"""
+Uploads of the report renderer to an S3 bucket served by moto
+"""
+class S3MultipartWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket=BUCKET)
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def read(self, key):
+        return self.s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+    def test_small_report_is_one_put_object(self):
+        with S3MultipartWriter(self.s3, BUCKET, 'small.txt', 'text/plain') as writer:
+            writer.write('first line\n')
+            writer.write('second line\n')
+
+        self.assertIsNone(writer.upload_id)
+        self.assertEqual(self.read('small.txt'), b'first line\nsecond line\n')
+        head = self.s3.head_object(Bucket=BUCKET, Key='small.txt')
+        self.assertEqual(head['ContentType'], 'text/plain')
+        self.assertNotIn('-', head['ETag'])
+
+    def test_large_report_is_a_multipart_upload(self):
+        line = 'x' * 1023 + '\n'
+        lines = PART_SIZE // len(line) + 10
+        with S3MultipartWriter(self.s3, BUCKET, 'large.txt', 'text/plain') as writer:
+            for _ in range(lines):
+                writer.write(line)
+
+        self.assertEqual([part['PartNumber'] for part in writer.parts], [1, 2])
+        self.assertEqual(self.read('large.txt'), (line * lines).encode('utf-8'))
+        head = self.s3.head_object(Bucket=BUCKET, Key='large.txt')
+        self.assertTrue(head['ETag'].strip('"').endswith('-2'))
+
+    def test_error_aborts_the_upload(self):
+        with self.assertRaises(RuntimeError):
+            with S3MultipartWriter(self.s3, BUCKET, 'failed.txt', 'text/plain') as writer:
+                writer.write('x' * (PART_SIZE + 1))
+                raise RuntimeError('rendering failed')
+
+        self.assertIsNotNone(writer.upload_id)
+        self.assertNotIn('Uploads', self.s3.list_multipart_uploads(Bucket=BUCKET))
+        self.assertNotIn('Contents', self.s3.list_objects_v2(Bucket=BUCKET))
+
+    def test_archive_report_links_every_format(self):
+        links = archive_report(self.s3, BUCKET, 'reports/', create_window_uptimes(),
+            GENERATED_TIME)
+
+        self.assertEqual(sorted(links), ['csv', 'html', 'json'])
+        for report_format, link in links.items():
+            key = 'reports/2024-03-01T063000/uptime.{}'.format(report_format)
+            self.assertIn('/' + key, link)
+            self.assertIn('Expires=', link)
+
+        report = json.loads(self.read('reports/2024-03-01T063000/uptime.json'))
+        self.assertEqual(report['generated'], GENERATED_TIME.isoformat())
+        self.assertEqual([row['resource'] for row in report['results']],
+            ['service0', 'service1', 'service2', 'service3'])
+        self.assertIsNone(report['results'][2]['uptime'])
+
+        rows = list(csv.DictReader(io.StringIO(
+            self.read('reports/2024-03-01T063000/uptime.csv').decode('utf-8'))))
+        self.assertEqual(rows[3]['uptime'], '97.25')
+
+        page = self.read('reports/2024-03-01T063000/uptime.html').decode('utf-8')
+        self.assertIn('<td>SERVICE3</td><td>97.250</td>', page)
+
+class SummaryMessageTest(unittest.TestCase):
+    def test_summary_lists_links_and_lowest_uptimes(self):
+        links = {'json': 'https://example.com/uptime.json',
+            'csv': 'https://example.com/uptime.csv'}
+        message = create_summary_message(create_window_uptimes(), links)
+
+        self.assertEqual(message,
+            "Uptime report summary. The full report is available at:\n\n"
+            "\tCSV: https://example.com/uptime.csv\n"
+            "\tJSON: https://example.com/uptime.json\n"
+            "\n*****last month: 2024-02-01 00:00:00 --- 2024-03-01 00:00:00*****\n\n"
+            "\t4 resources, 1 never observed\n"
+            "\tSERVICE3: 97.250\n"
+            "\tSERVICE0: 99.500\n"
+            "\tSERVICE1: 100.000\n")
+
+if __name__ == '__main__':
+    unittest.main()
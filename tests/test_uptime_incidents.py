@@ -0,0 +1,65 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from uptime_incidents import IncidentTracker
+
+#Start of the series, in seconds since the epoch
+START = 1704067200
+
+PERIOD = 60
+
+"""
+Feed a series described by a string to a tracker, one character per
+minute: 'd' down, 'u' up and '.' no datapoint
+"""
+def track(series, merge_threshold):
+    tracker = IncidentTracker(merge_threshold)
+    for index, state in enumerate(series):
+        if state != '.':
+            tracker.add(START + index * PERIOD, PERIOD, state == 'd')
+    return tracker.summary()
+
+class IncidentTrackerTest(unittest.TestCase):
+    def test_no_incident(self):
+        summary = track('uuuuu', 300)
+        self.assertEqual(summary['incidents'], 0)
+        self.assertIsNone(summary['mttr'])
+        self.assertIsNone(summary['mtbf'])
+
+    def test_contiguous_outage_is_one_incident(self):
+        for merge_threshold in (0, 300):
+            summary = track('uu' + 'd' * 10 + 'uu', merge_threshold)
+            self.assertEqual(summary['incidents'], 1)
+            self.assertEqual(summary['longest_outage'], 600)
+            self.assertEqual(summary['mttr'], 600)
+            self.assertEqual(summary['mtbf'], 240)
+
+    def test_flaps_within_threshold_are_merged(self):
+        summary = track('ddudduuudd' + 'u' * 10, 180)
+        self.assertEqual(summary['incidents'], 1)
+        self.assertEqual(summary['longest_outage'], 600)
+        self.assertEqual(summary['mtbf'], 600)
+
+    def test_failures_further_apart_are_separate_incidents(self):
+        summary = track('dduuuudddu', 180)
+        self.assertEqual(summary['incidents'], 2)
+        self.assertEqual(summary['longest_outage'], 180)
+        self.assertEqual(summary['longest_outage_start'].minute, 6)
+        self.assertEqual(summary['mttr'], 150)
+        self.assertEqual(summary['mtbf'], 150)
+
+    def test_gap_neither_ends_nor_extends_an_incident(self):
+        summary = track('dd.....dd', 0)
+        self.assertEqual(summary['incidents'], 1)
+        self.assertEqual(summary['longest_outage'], 240)
+
+    def test_gap_does_not_count_as_up_time(self):
+        summary = track('d' + '.' * 10 + 'uu' + 'd', 60)
+        self.assertEqual(summary['incidents'], 2)
+        self.assertEqual(summary['mttr'], 60)
+        self.assertEqual(summary['mtbf'], 60)
+
+if __name__ == '__main__':
+    unittest.main()